@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmark of the scanner's per-file overhead as trees get deeper
+
+Builds a chain of nested directories with the same number of files at each
+level, then reports the time taken per scanned entry by the recursive walker
+the scanner used to have, and by :func:`scan_serial`. The per-entry cost of
+:func:`scan_serial` should stay flat as the depth grows.
+
+Run with ``python benchmarks/scan_depth.py``
+"""
+
+from grafanadb.dusql_scan import root_directory, scan_serial
+
+import argparse
+import os
+import tempfile
+import time
+
+
+def build_tree(path, depth, files):
+    for _ in range(depth):
+        for i in range(files):
+            open(os.path.join(path, f"f{i}"), "w").close()
+        path = os.path.join(path, "d")
+        os.mkdir(path)
+
+
+def recursive_scan(path, scan_time, device, ipath):
+    """
+    The scanner before :func:`scan_serial`, for comparison. Each entry copies
+    the list of inodes from the root, is stat()ed by its full path, and its
+    row is passed up through one generator for every level above it
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            entry_ipath = ipath + [entry.inode()]
+            stat = entry.stat(follow_symlinks=False)
+
+            if entry.is_dir(follow_symlinks=False) and device == stat.st_dev:
+                yield from recursive_scan(entry.path, scan_time, device, entry_ipath)
+
+            yield (
+                stat.st_ino,
+                device,
+                stat.st_mode,
+                stat.st_uid,
+                stat.st_gid,
+                stat.st_size,
+                stat.st_mtime,
+                stat.st_atime,
+                scan_time,
+                entry.name.decode("utf-8", "backslashreplace"),
+                entry_ipath[0],
+                entry_ipath[-2] if len(entry_ipath) >= 2 else None,
+            )
+
+
+def time_scan(scan, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in scan())
+        best = min(best, time.perf_counter() - start)
+
+    return count, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--depths", type=int, nargs="+", default=[10, 100, 900])
+    parser.add_argument("--entries", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'depth':>6s} {'entries':>8s} {'us/entry':>9s} {'(recursive)':>11s}")
+    for depth in args.depths:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            build_tree(tmpdir, depth, max(1, args.entries // depth))
+            row, directory = root_directory(tmpdir)
+
+            count, elapsed = time_scan(lambda: scan_serial(directory), args.repeat)
+            _, recursive = time_scan(
+                lambda: recursive_scan(
+                    directory.path,
+                    directory.scan_time,
+                    directory.device,
+                    [directory.inode],
+                ),
+                args.repeat,
+            )
+
+            print(
+                f"{depth:6d} {count:8d} {elapsed / count * 1e6:9.2f} "
+                f"{recursive / count * 1e6:11.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -13,13 +13,29 @@ set -euo pipefail
 
 module use /g/data/hh5/public/modules
 
-module load parallel
 module load conda
 
 #set -x
 
 PROJECTS="p66 hh5/tmp v45 w40 w42 w97 ly62"
 
-sed -e 's:\<\(\S\+\):/g/data/\1 /scratch/\1:g' -e 's:\s\+:\n:g' <<< $PROJECTS | parallel -v --jobs 4 python src/grafanadb/dusql_scan.py {} --output $TMPDIR/'dusql.{= $_=~ s:/:_:g =}.csv'
+ROOTS=$(sed -e 's:\<\(\S\+\):/g/data/\1 /scratch/\1:g' <<< $PROJECTS)
+
+# Keep the work directory off jobfs, so a scan killed at its walltime can be
+# resumed by the next job
+export DUSQL_WORKDIR=${DUSQL_WORKDIR:-/scratch/hh5/$USER/dusql_work}
+export DUSQL_OUTPUT=$DUSQL_WORKDIR/output
+
+SCAN_ARGS="--workdir $DUSQL_WORKDIR --processes ${PBS_NCPUS:-4} --workers 4 --format binary --compress --rollup --output-dir $DUSQL_OUTPUT"
+
+# Scan all roots together, splitting large trees between the available cpus
+if [ -e $DUSQL_WORKDIR/seeded ]; then
+    python src/grafanadb/dusql_scan.py $SCAN_ARGS --resume
+else
+    python src/grafanadb/dusql_scan.py $ROOTS $SCAN_ARGS
+fi
 
 ./run_update.sh
+
+# Start from scratch next time
+rm -r $DUSQL_WORKDIR
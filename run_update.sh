@@ -16,47 +16,7 @@ module use /g/data/hh5/public/modules
 module load conda
 
 
-cat > $TMPDIR/dusql_update_head <<EOF
-BEGIN;
-
-DROP TABLE IF EXISTS dusql_inode CASCADE;
-
-CREATE UNLOGGED TABLE dusql_inode (
-        basename TEXT NOT NULL,
-        inode BIGINT,
-        device BIGINT NOT NULL,
-        mode INTEGER,
-        uid INTEGER,
-        gid INTEGER,
-        size BIGINT,
-        mtime FLOAT,
-        atime FLOAT,
-        scan_time FLOAT,
-        root_inode BIGINT,
-        parent_inode BIGINT
-);
-
-COPY dusql_inode(
-    inode,
-    device,
-    mode,
-    uid,
-    gid,
-    size,
-    mtime,
-    atime,
-    scan_time,
-    basename,
-    root_inode,
-    parent_inode
-) FROM STDIN WITH (FORMAT CSV);
-EOF
-
-cat > $TMPDIR/dusql_update_tail <<EOF
-\.
-
-COMMIT;
-EOF
+DUSQL_OUTPUT=${DUSQL_OUTPUT:-$TMPDIR}
 
 # Tunnel to the jenkins server
 ssh -W 10.0.3.190 -NL 9876:localhost:5432 accessdev.nci.org.au &
@@ -66,5 +26,8 @@ trap "{ kill $tunnelid; }" EXIT
 
 sleep 2
 
-time psql -h localhost -p 9876  -d grafana -f <(cat $TMPDIR/dusql_update_head $TMPDIR/dusql.*.csv $TMPDIR/dusql_update_tail sql/dusql_schema.sql)
+# Tables the load records history in, needed before the first load
+time psql -h localhost -p 9876  -d grafana -f sql/dusql_schema.sql
 
+# Builds the new tables alongside the current ones in parallel, then swaps them in
+time PYTHONPATH=src python -m grafanadb.load postgresql://localhost:9876/grafana $DUSQL_OUTPUT/dusql*
@@ -6,5 +6,11 @@ import versioneer
 setup(
     version=versioneer.get_version(),
     cmdclass=versioneer.get_cmdclass(),
-    entry_points={"console_scripts": ["dusql = grafanadb.cli:main"]},
+    entry_points={
+        "console_scripts": [
+            "dusql = grafanadb.cli:main",
+            "dusql-load = grafanadb.load:main",
+            "dusql-warm = grafanadb.warm:main",
+        ]
+    },
 )
@@ -1,26 +1,13 @@
 /*
- * Stores information about the current state of the filesystem
- * Information comes from running stat() on each file
+ * The current state of the filesystem is in the views dusql_inode,
+ * dusql_dir_rollup, dusql_dir_path and dusql_root, which are created by grafanadb.load
+ * and point at the tables of the latest load. See 'tables' in
+ * src/grafanadb/load.py for their columns.
  */
-CREATE UNLOGGED TABLE IF NOT EXISTS dusql_inode (
-        basename TEXT NOT NULL,
-        inode BIGINT,
-        device BIGINT,
-        mode INTEGER,
-        uid INTEGER,
-        gid INTEGER,
-        size BIGINT,
-        mtime FLOAT,
-        scan_time FLOAT,
-        root_inode BIGINT, -- inode of directory that was scanned to find this file
-        parent_inode BIGINT -- inode of this file's parent directory
-);
-CREATE INDEX IF NOT EXISTS dusql_inode_id ON dusql_inode(device, inode);
-CREATE INDEX IF NOT EXISTS dusql_inode_parent ON dusql_inode(device, parent_inode);
-GRANT SELECT ON dusql_inode TO dusql;
 
 /*
  * Stores a summary of historical filesystem state
+ * Filled in by grafanadb.load from the rollups of each scanned root
  */
 CREATE TABLE IF NOT EXISTS dusql_history (
     id SERIAL PRIMARY KEY,
@@ -35,6 +22,7 @@ GRANT SELECT ON dusql_history TO grafana_ro;
 
 /*
  * Stores file expiry predictions
+ * Filled in by grafanadb.load from the rollups of each scanned root
  */
 CREATE TABLE IF NOT EXISTS dusql_access (
     id SERIAL PRIMARY KEY,
@@ -49,28 +37,36 @@ GRANT SELECT ON dusql_access TO grafana_ro;
 
 /*
  * Create a path given (parent_inode, device, basename) of an inode
+ *
+ * Kept for compatibility, joining to dusql_dir_path on the parent is much
+ * quicker. Written in plpgsql so this file can be run before grafanadb.load
+ * has created dusql_inode.
 */
 CREATE OR REPLACE FUNCTION dusql_path_func(search_parent_inode BIGINT, search_device BIGINT, search_basename TEXT) RETURNS TEXT AS $$
-        WITH RECURSIVE x AS (
-                SELECT
-                        search_parent_inode AS parent_inode,
-                        search_basename AS basename,
-                        0 AS depth
-                UNION ALL
-                SELECT
-                        dusql_inode.parent_inode AS parent_inode,
-                        dusql_inode.basename AS basename,
-                        depth + 1 AS depth
-                FROM
-                        x
-                JOIN    dusql_inode
-                ON      x.parent_inode = dusql_inode.inode
-                AND     search_device = dusql_inode.device
-        )
-        SELECT string_agg(basename, '/') AS path
-        FROM (
-                SELECT basename FROM x
-                ORDER BY depth DESC
-        ) AS y
-$$ LANGUAGE SQL;
+BEGIN
+        RETURN (
+                WITH RECURSIVE x AS (
+                        SELECT
+                                search_parent_inode AS parent_inode,
+                                search_basename AS basename,
+                                0 AS depth
+                        UNION ALL
+                        SELECT
+                                dusql_inode.parent_inode AS parent_inode,
+                                dusql_inode.basename AS basename,
+                                depth + 1 AS depth
+                        FROM
+                                x
+                        JOIN    dusql_inode
+                        ON      x.parent_inode = dusql_inode.inode
+                        AND     search_device = dusql_inode.device
+                )
+                SELECT string_agg(basename, '/') AS path
+                FROM (
+                        SELECT basename FROM x
+                        ORDER BY depth DESC
+                ) AS y
+        );
+END
+$$ LANGUAGE plpgsql STABLE;
 
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlalchemy as sa
+import psycopg2.errors
+import collections
+import threading
+import sqlite3
+import time
+import json
+
+# Returned by get() for results that aren't in the cache
+missing = object()
+
+
+def query_key(name, query):
+    """
+    Normalised cache key for the request `query` to the endpoint `name`
+    """
+    return json.dumps([name, query], sort_keys=True, separators=(",", ":"))
+
+
+def current_generation(conn):
+    """
+    The generation of the snapshot currently published, None if nothing has
+    been published by grafanadb.load
+    """
+    try:
+        return conn.execute(
+            sa.text("SELECT id FROM dusql_generation ORDER BY id DESC LIMIT 1")
+        ).scalar()
+    except sa.exc.ProgrammingError as e:
+        if isinstance(e.orig, psycopg2.errors.UndefinedTable):
+            return None
+        raise
+
+
+class ResultCache:
+    """
+    Least recently used cache of results for the current generation
+
+    Results are only valid for the snapshot they were computed from, so
+    they're stored along with its generation from :func:`current_generation`,
+    which changes whenever grafanadb.load publishes a new snapshot. Holds at
+    most `maxsize` results, each for at most `ttl` seconds. Once a
+    result from a newer generation is stored everything older is dropped.
+    """
+
+    def __init__(self, maxsize=8192, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self.lock = threading.Lock()
+        self.results = collections.OrderedDict()
+        self.generation = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.invalidations = 0
+
+    def get(self, generation, key):
+        """
+        The result for `key` computed from `generation`, or `missing`
+        """
+        with self.lock:
+            if generation != self.generation or key not in self.results:
+                self.misses += 1
+                return missing
+
+            stored, value = self.results[key]
+            if time.monotonic() - stored > self.ttl:
+                del self.results[key]
+                self.expired += 1
+                self.misses += 1
+                return missing
+
+            self.results.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, generation, key, value):
+        """
+        Store the result `value` for `key` computed from `generation`
+        """
+        with self.lock:
+            if generation != self.generation:
+                if self.generation is not None and generation is not None:
+                    if generation < self.generation:
+                        # Computed before a newer snapshot was published
+                        return
+                self.results.clear()
+                self.generation = generation
+                self.invalidations += 1
+
+            self.results[key] = (time.monotonic(), value)
+            self.results.move_to_end(key)
+
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+    def cached(self, generation, key, compute):
+        """
+        The result for `key`, calling `compute` to get it if it's not in the
+        cache
+        """
+        value = self.get(generation, key)
+        if value is missing:
+            value = compute()
+            self.put(generation, key, value)
+        return value
+
+    def clear(self):
+        """
+        Remove all results
+        """
+        with self.lock:
+            self.results.clear()
+
+    def stats(self):
+        """
+        Hit and miss counts and the current size of the cache
+        """
+        with self.lock:
+            return {
+                "generation": self.generation,
+                "size": len(self.results),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "invalidations": self.invalidations,
+            }
+
+
+class SqliteCache(ResultCache):
+    """
+    :class:`ResultCache` stored in the SQLite database `path`, so it can be
+    shared by all the server processes on a host and survives them
+    restarting
+
+    Results are stored as JSON. The least recently used results are removed
+    once there are more than `maxsize`.
+
+    SQLite only allows one writer at a time, so cache hits don't write.
+    When a result was last used is only updated every `touch_interval`
+    seconds, and each process adds its hit and miss counts to the shared
+    ones when it stores a result, or every `flush_interval` seconds.
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS result (
+        key TEXT PRIMARY KEY,
+        generation INTEGER,
+        stored REAL,
+        used REAL,
+        value TEXT
+    );
+    CREATE INDEX IF NOT EXISTS result_used ON result(used);
+    CREATE INDEX IF NOT EXISTS result_generation ON result(generation);
+    CREATE TABLE IF NOT EXISTS counter (
+        name TEXT PRIMARY KEY,
+        value INTEGER
+    );
+    """
+
+    counters = ["hits", "misses", "evictions", "expired", "invalidations"]
+
+    def __init__(
+        self, path, maxsize=8192, ttl=3600, touch_interval=60, flush_interval=10
+    ):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.flush_interval = flush_interval
+        self.local = threading.local()
+
+        self.counts_lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.flushed = time.monotonic()
+
+        with self.connect() as db:
+            db.executescript(self.schema)
+            db.executemany(
+                "INSERT OR IGNORE INTO counter(name, value) VALUES (?, 0)",
+                [(c,) for c in self.counters],
+            )
+
+    def connect(self):
+        """
+        This thread's connection to the cache database
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def count(self, name, n=1):
+        with self.counts_lock:
+            self.counts[name] += n
+
+    def flush(self, db):
+        """
+        Add the counts from this process to the shared ones
+        """
+        with self.counts_lock:
+            counts, self.counts = self.counts, collections.Counter()
+            self.flushed = time.monotonic()
+        db.executemany(
+            "UPDATE counter SET value = value + ? WHERE name = ?",
+            [(n, name) for name, n in counts.items()],
+        )
+
+    def get(self, generation, key):
+        now = time.time()
+        with self.connect() as db:
+            row = db.execute(
+                "SELECT stored, used, value FROM result "
+                "WHERE key = ? AND generation IS ?",
+                (key, generation),
+            ).fetchone()
+
+            if row is None:
+                self.count("misses")
+                value = missing
+            elif now - row[0] > self.ttl:
+                # Replaced once it's computed again
+                self.count("expired")
+                self.count("misses")
+                value = missing
+            else:
+                if now - row[1] > self.touch_interval:
+                    db.execute("UPDATE result SET used = ? WHERE key = ?", (now, key))
+                self.count("hits")
+                value = json.loads(row[2])
+
+            if time.monotonic() - self.flushed > self.flush_interval:
+                self.flush(db)
+
+        return value
+
+    def put(self, generation, key, value):
+        now = time.time()
+        with self.connect() as db:
+            latest = db.execute("SELECT max(generation) FROM result").fetchone()[0]
+            if latest is not None and generation is not None:
+                if generation < latest:
+                    # Computed before a newer snapshot was published
+                    return
+                if generation > latest:
+                    db.execute("DELETE FROM result")
+                    self.count("invalidations")
+
+            db.execute(
+                "INSERT OR REPLACE INTO result(key, generation, stored, used, value) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, generation, now, now, json.dumps(value)),
+            )
+
+            excess = db.execute("SELECT count(*) FROM result").fetchone()[0]
+            excess -= self.maxsize
+            if excess > 0:
+                db.execute(
+                    "DELETE FROM result WHERE key IN "
+                    "(SELECT key FROM result ORDER BY used LIMIT ?)",
+                    (excess,),
+                )
+                self.count("evictions", excess)
+
+            self.flush(db)
+
+    def clear(self):
+        with self.connect() as db:
+            db.execute("DELETE FROM result")
+
+    def stats(self):
+        with self.connect() as db:
+            self.flush(db)
+            stats = dict(db.execute("SELECT name, value FROM counter"))
+            stats["generation"] = db.execute(
+                "SELECT max(generation) FROM result"
+            ).fetchone()[0]
+            stats["size"] = db.execute("SELECT count(*) FROM result").fetchone()[0]
+        stats["maxsize"] = self.maxsize
+        stats["ttl"] = self.ttl
+        stats["path"] = self.path
+        return stats
+
+
+def open_cache(path=None, maxsize=8192, ttl=3600):
+    """
+    A :class:`SqliteCache` shared through `path`, or a :class:`ResultCache`
+    for just this process if `path` is None
+    """
+    if path is None:
+        return ResultCache(maxsize=maxsize, ttl=ttl)
+    return SqliteCache(path, maxsize=maxsize, ttl=ttl)
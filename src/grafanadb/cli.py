@@ -21,6 +21,8 @@ from grafanadb.find import find_parse
 import argparse
 import textwrap
 import requests
+import json
+import sys
 
 
 def main():
@@ -35,6 +37,7 @@ def main():
     subparser = parser.add_subparsers(help="Sub-commands")
     Find.init_parser(subparser)
     Du.init_parser(subparser)
+    Top.init_parser(subparser)
     Ncdu.init_parser(subparser)
 
     args = parser.parse_args()
@@ -71,7 +74,7 @@ class Du:
         parser.add_argument(
             "--mtime",
             metavar="N",
-            help='File modification time (can be a year: "2018", date "20170602", or timedelta before today "1y6m")',
+            help='File modification time (can be a year: "2018", date "20170602", timedelta before today "1y6m", or age before the scan "P1M", "P6M", "P1Y", "P3Y")',
         )
         parser.add_argument("--size", metavar="N", help='File size ("16m", "1GB")')
 
@@ -79,16 +82,77 @@ class Du:
 
     @classmethod
     def run(cls, args):
-        for root in args.path:
-            f_args = find_parse(root, args.group, args.user, args.mtime, args.size)
+        f_args = find_parse(args.path, args.group, args.user, args.mtime, args.size)
 
-            r = requests.get("https://accessdev.nci.org.au/dusql/du", json=f_args)
-            r.raise_for_status()
-            r = r.json()
+        # Each path's usage in one request
+        r = requests.get("https://accessdev.nci.org.au/dusql/du/batch", json=f_args)
+        r.raise_for_status()
 
+        for root, r in zip(args.path, r.json()):
             print(f'{pretty_size(r["size"])}, {r["inodes"]:8d} files, {root}')
 
 
+class Top:
+    """
+    Show the largest files, or directories with --dirs, under the paths
+
+    Note that only CLEX project storage is available for search
+
+    'NAME' arguments can start with either '!' or '-' to find files that don't
+    have that name
+
+    'N' arguments can start with '+' to find files greater/newer than N or '-'
+    to find files less/older than N. Directories can only be filtered by user,
+    group and an --mtime age.
+    """
+
+    @classmethod
+    def init_parser(cls, subparser):
+        parser = subparser.add_parser(
+            "top",
+            help="Show the largest files or directories",
+            description=textwrap.dedent(cls.__doc__),
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+        parser.add_argument("path", nargs="+", help="Root search paths")
+        parser.add_argument(
+            "--count", "-n", type=int, default=50, help="Number to show (default 50)"
+        )
+        parser.add_argument(
+            "--dirs", action="store_true", help="Show directories instead of files"
+        )
+        parser.add_argument(
+            "--inodes",
+            action="store_true",
+            help="Order directories by number of files rather than size",
+        )
+        parser.add_argument("--group", metavar="NAME", help="File belongs to group")
+        parser.add_argument("--user", metavar="NAME", help="File belongs to user")
+        parser.add_argument(
+            "--mtime",
+            metavar="N",
+            help='File modification time (can be a year: "2018", date "20170602", timedelta before today "1y6m", or age before the scan "P1M", "P6M", "P1Y", "P3Y")',
+        )
+        parser.add_argument("--size", metavar="N", help='File size ("16m", "1GB")')
+
+        parser.set_defaults(run=cls.run)
+
+    @classmethod
+    def run(cls, args):
+        f_args = find_parse(args.path, args.group, args.user, args.mtime, args.size)
+        f_args["count"] = args.count
+        f_args["directories"] = args.dirs
+        f_args["by"] = "inodes" if args.inodes else "size"
+
+        r = requests.get("https://accessdev.nci.org.au/dusql/top", json=f_args)
+        r.raise_for_status()
+
+        for row in r.json():
+            print(
+                f'{pretty_size(row["size"])}, {row["inodes"]:8d} files, {row["path"]}'
+            )
+
+
 class Ncdu:
     """
     Interactively view the disk usage of matching files 
@@ -116,7 +180,7 @@ class Ncdu:
         parser.add_argument(
             "--mtime",
             metavar="N",
-            help='File modification time (can be a year: "2018", date "20170602", or timedelta before today "1y6m")',
+            help='File modification time (can be a year: "2018", date "20170602", timedelta before today "1y6m", or age before the scan "P1M", "P6M", "P1Y", "P3Y")',
         )
         parser.add_argument("--size", metavar="N", help='File size ("16m", "1GB")')
 
@@ -130,7 +194,7 @@ class Ncdu:
         f_args = find_parse(args.path, args.group, args.user, args.mtime, args.size)
         curses.wrapper(ncdu.main, args.path[0], f_args)
 
-        print(ncdu.cached_du.cache_info())
+        print(ncdu.cached_children.cache_info())
 
 
 def pretty_size(size):
@@ -172,21 +236,40 @@ class Find:
         parser.add_argument(
             "--mtime",
             metavar="N",
-            help='File modification time (can be a year: "2018", date "20170602", or timedelta before today "1y6m")',
+            help='File modification time (can be a year: "2018", date "20170602", timedelta before today "1y6m", or age before the scan "P1M", "P6M", "P1Y", "P3Y")',
         )
         parser.add_argument("--size", metavar="N", help='File size ("16m", "1GB")')
+        parser.add_argument(
+            "--limit", metavar="N", type=int, help="Only list the first N files"
+        )
+        parser.add_argument(
+            "--after",
+            metavar="CURSOR",
+            help="Continue a listing from the cursor printed by --limit",
+        )
 
         parser.set_defaults(run=cls.run)
 
     @classmethod
     def run(cls, args):
         f_args = find_parse(args.roots, args.group, args.user, args.mtime, args.size)
+        f_args["limit"] = args.limit
+        f_args["after"] = args.after
 
-        r = requests.get("https://accessdev.nci.org.au/dusql/find", json=f_args)
+        r = requests.get(
+            "https://accessdev.nci.org.au/dusql/find", json=f_args, stream=True
+        )
         r.raise_for_status()
 
-        for row in r.json():
-            print(row)
+        # Results are newline-delimited JSON, print them as they arrive
+        for line in r.iter_lines():
+            row = json.loads(line)
+            if "after" in row:
+                print(
+                    f"More files, continue with --after {row['after']}", file=sys.stderr
+                )
+            else:
+                print(row["path"])
 
 
 if __name__ == "__main__":
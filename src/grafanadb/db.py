@@ -19,13 +19,89 @@
 import sqlalchemy as sa
 from sqlalchemy.orm import sessionmaker
 from contextlib import contextmanager
-
-engine = None
+import threading
+import time
 
 Session = sessionmaker()
 
 default_url="postgresql://localhost:9876/grafana"
 
+# Settings for the engines created by get_engine(), change with configure()
+#   pool_size: Connections kept open to each database
+#   max_overflow: Extra connections opened when all of those are in use
+#   pool_timeout: Seconds to wait for a connection once there are no more
+#   pool_recycle: Seconds before a connection is replaced
+#   pool_pre_ping: Check connections still work before using them, so they
+#       are replaced after the database restarts
+#   statement_timeout: Seconds before the database cancels a query, None
+#       for no limit
+pool_options = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_timeout': 30,
+    'pool_recycle': 30 * 60,
+    'pool_pre_ping': True,
+    'statement_timeout': None,
+}
+
+# Engines by URL
+engines = {}
+
+# ReadRouters by (primary, replicas)
+routers = {}
+engines_lock = threading.Lock()
+
+
+def configure(**options):
+    """
+    Change the settings in `pool_options` for engines created from now on
+    """
+    unknown = set(options) - set(pool_options)
+    if unknown:
+        raise TypeError(f"Unknown pool options {sorted(unknown)}")
+    pool_options.update(options)
+
+
+def create_engine(url, statement_timeout=None, connect_timeout=60, **options):
+    """
+    A new engine for `url`, `options` are passed to sqlalchemy.create_engine
+    """
+    connect_args = {'connect_timeout': connect_timeout}
+    if statement_timeout is not None:
+        connect_args['options'] = f'-c statement_timeout={int(statement_timeout * 1000)}'
+
+    return sa.create_engine(url, connect_args=connect_args, **options)
+
+
+def get_engine(url=default_url):
+    """
+    The engine for `url`, with its own pool of connections. Created with
+    the current `pool_options` the first time it's needed.
+
+    Session is bound to the first engine created
+    """
+    with engines_lock:
+        if url not in engines:
+            engines[url] = create_engine(url, **pool_options)
+            if Session.kw.get('bind') is None:
+                Session.configure(bind=engines[url])
+        return engines[url]
+
+
+def pool_status():
+    """
+    Connections in use by each engine
+    """
+    with engines_lock:
+        return {
+            repr(engine.url): {
+                'size': engine.pool.size(),
+                'checked_out': engine.pool.checkedout(),
+                'overflow': engine.pool.overflow(),
+            }
+            for engine in engines.values()
+        }
+
 
 @contextmanager
 def connect(url=default_url):
@@ -34,14 +110,208 @@ def connect(url=default_url):
 
         with connect() as conn:
             conn.execute(q)
+
+    The connection comes from the pool of :func:`get_engine`, and is
+    returned to it afterwards
+    """
+    conn = get_engine(url).connect()
+
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+class ReadRouter:
+    """
+    Sends read-only queries to one of the databases in `replicas`, picking
+    the one with the fewest queries running from this process, or to
+    `primary` if there are no replicas available. Loads always write to the
+    primary.
+
+    A replica that can't be connected to is skipped for `retry` seconds.
+
+    If `version` is given it's called with a connection to each database at
+    most every `interval` seconds, and replicas that return less than the
+    primary are skipped until they catch up, e.g. ones that haven't yet
+    received the latest load. These checks give up after `check_timeout`
+    seconds.
     """
-    global engine
-    if engine is None:
-        engine = sa.create_engine(url, connect_args={'connect_timeout': 60})
-        Session.configure(bind=engine)
 
-    conn = engine.connect()
+    def __init__(
+        self, primary, replicas=(), version=None, interval=10, retry=30, check_timeout=5
+    ):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.version_of = version
+        self.interval = interval
+        self.retry = retry
+        self.check_timeout = check_timeout
+
+        self.lock = threading.Lock()
+        self.outstanding = {url: 0 for url in self.replicas}
+        self.down_until = {}
+        self.behind = set()
+        self.check_engines = {}
+
+        self.check_lock = threading.Lock()
+        self.checked = None
+        self.current = None
+
+    def check(self):
+        """
+        Look for replicas behind the primary, if it's been more than
+        `interval` seconds since the last check
+
+        Only the first check is waited for, after that other threads carry on
+        with the last known state while one thread updates it
+        """
+        if not self.check_lock.acquire(blocking=self.checked is None):
+            return
+        try:
+            now = time.monotonic()
+            if self.checked is not None and now - self.checked <= self.interval:
+                return
+            if self.version_of is not None:
+                self.check_versions()
+            self.checked = now
+        finally:
+            self.check_lock.release()
+
+    def check_engine(self, url):
+        """
+        Engine for checking `url`, which gives up quickly if it's unavailable
+        """
+        with self.lock:
+            if url not in self.check_engines:
+                self.check_engines[url] = create_engine(
+                    url,
+                    connect_timeout=self.check_timeout,
+                    statement_timeout=self.check_timeout,
+                    poolclass=sa.pool.NullPool,
+                )
+            return self.check_engines[url]
+
+    def check_versions(self):
+        current = self.current
+        try:
+            with self.check_engine(self.primary).connect() as conn:
+                current = self.version_of(conn)
+        except sa.exc.OperationalError:
+            # Keep using the replicas while the primary is unavailable
+            pass
+
+        behind = set()
+        for url in self.replicas:
+            with self.lock:
+                down = self.down_until.get(url, 0) > time.monotonic()
+            if down:
+                # Not retried until `retry` has passed
+                if url in self.behind:
+                    behind.add(url)
+                continue
+
+            try:
+                with self.check_engine(url).connect() as conn:
+                    v = self.version_of(conn)
+            except sa.exc.OperationalError:
+                self.failed(url)
+                continue
+            if current is not None and (v is None or v < current):
+                behind.add(url)
+
+        with self.lock:
+            self.current = current
+            self.behind = behind
 
-    yield conn
+    def version(self):
+        """
+        The primary's `version` as of the last check. Replicas in use are at
+        least this version.
+        """
+        self.check()
+        return self.current
 
-    conn.close()
+    def failed(self, url):
+        with self.lock:
+            self.down_until[url] = time.monotonic() + self.retry
+
+    def acquire(self):
+        """
+        The available replica with the fewest outstanding queries, None if
+        there are none
+        """
+        with self.lock:
+            now = time.monotonic()
+            ready = [
+                url for url in self.replicas
+                if url not in self.behind and self.down_until.get(url, 0) <= now
+            ]
+            if len(ready) == 0:
+                return None
+            url = min(ready, key=self.outstanding.get)
+            self.outstanding[url] += 1
+            return url
+
+    def release(self, url):
+        with self.lock:
+            self.outstanding[url] -= 1
+
+    @contextmanager
+    def connect(self):
+        """
+        Get a connection for read-only queries (context manager)::
+
+            with router.connect() as conn:
+                conn.execute(q)
+        """
+        self.check()
+
+        while True:
+            url = self.acquire()
+            if url is None:
+                break
+
+            try:
+                conn = get_engine(url).connect()
+            except sa.exc.OperationalError:
+                self.release(url)
+                self.failed(url)
+                continue
+
+            try:
+                yield conn
+            finally:
+                conn.close()
+                self.release(url)
+            return
+
+        with connect(self.primary) as conn:
+            yield conn
+
+    def status(self):
+        """
+        Outstanding queries and availability of each replica
+        """
+        with self.lock:
+            now = time.monotonic()
+            return {
+                repr(sa.engine.url.make_url(url)): {
+                    'outstanding': self.outstanding[url],
+                    'down': self.down_until.get(url, 0) > now,
+                    'behind': url in self.behind,
+                }
+                for url in self.replicas
+            }
+
+
+def read_router(primary, replicas=(), **options):
+    """
+    The :class:`ReadRouter` for `primary` and `replicas`, created with
+    `options` the first time it's needed
+    """
+    key = (primary, tuple(replicas))
+    with engines_lock:
+        if key not in routers:
+            routers[key] = ReadRouter(primary, replicas, **options)
+        return routers[key]
@@ -23,9 +23,159 @@ import time
 import argparse
 import sys
 import types
+import collections
+import queue
+import threading
+import multiprocessing
+import itertools
+import json
+import random
+import socket
+import sqlite3
+import tempfile
+import struct
+import gzip
+import contextlib
+import io
+import functools
+import glob
+import bisect
+import calendar
+import datetime
 
 
-def scan_entry(parent_device, parent_inode, scan_time, basename, stat, ipath):
+# Names of the fields in each scanned row
+columns = (
+    "inode",
+    "device",
+    "mode",
+    "uid",
+    "gid",
+    "size",
+    "mtime",
+    "atime",
+    "scan_time",
+    "basename",
+    "root_inode",
+    "parent_inode",
+    "seq",
+)
+
+
+def bytea(value):
+    """
+    Convert a PostgreSQL hex format bytea string to bytes
+    """
+    return bytes.fromhex(value[2:])
+
+
+column_types = (
+    int,
+    int,
+    int,
+    int,
+    int,
+    int,
+    float,
+    float,
+    float,
+    str,
+    int,
+    int,
+    bytea,
+)
+
+# Prefix-free encodings of small numbers
+_small_seq = [bytes([1, n]) for n in range(256)]
+
+
+def seq_key(n):
+    """
+    Encode the number `n` identifying an entry within its directory, its
+    inode, for its `seq`
+
+    An entry's `seq` is its parent's `seq` followed by this key, so sorting
+    on `seq` gives the tree in depth-first pre-order. Using the inode rather
+    than the entry's position in the listing means adding or removing a file
+    doesn't change the `seq` of its siblings, so it only changes when a file
+    moves. Keys start with their
+    length, so byte-wise comparison matches numeric order and no key is a
+    prefix of another, which means everything under a directory has a `seq`
+    between the directory's `seq` and `seq + b"\\xff"`.
+    """
+    if n < 256:
+        return _small_seq[n]
+    b = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    return bytes([len(b)]) + b
+
+
+# Names of the fields in each rollup row, see :class:`Rollup`
+rollup_columns = (
+    "device",
+    "inode",
+    "root_inode",
+    "uid",
+    "gid",
+    "min_age",
+    "last_access",
+    "inodes",
+    "size",
+    "mtime",
+)
+
+rollup_column_types = (int, int, int, int, int, str, str, int, int, float)
+
+# Rollups are split by how long ago files were modified and accessed, into the
+# same bins as dusql_history and dusql_access. Each bin is (label, months,
+# days), holding files older than that but newer than the next bin.
+history_ages = (
+    ("P0D", 0, 0),
+    ("P1M", 1, 0),
+    ("P6M", 6, 0),
+    ("P1Y", 12, 0),
+    ("P3Y", 36, 0),
+)
+access_ages = (("P0D", 0, 0), ("P60D", 0, 60), ("P90D", 0, 90))
+
+
+@functools.lru_cache()
+def age_bins(scan_time, ages):
+    """
+    Get the times separating `ages` for a scan started at `scan_time`
+
+    Returns (times, labels), both oldest first. Months are counted in UTC, so
+    the database can work out the same times from the scan time.
+    """
+    now = datetime.datetime.fromtimestamp(scan_time, datetime.timezone.utc)
+
+    times = []
+    for label, months, days in ages:
+        month = now.year * 12 + now.month - 1 - months
+        year, month = divmod(month, 12)
+        day = min(now.day, calendar.monthrange(year, month + 1)[1])
+        then = now.replace(year=year, month=month + 1, day=day)
+        times.append((then - datetime.timedelta(days=days)).timestamp())
+
+    return times[::-1], [label for label, months, days in ages][::-1]
+
+
+def age_label(t, bins):
+    """
+    Label of the bin from :func:`age_bins` containing timestamp `t`, None
+    for missing or future timestamps
+    """
+    if t is None:
+        return None
+    times, labels = bins
+    i = bisect.bisect_right(times, t)
+    if i == len(times):
+        return None
+    return labels[i]
+
+
+def scan_entry(
+    parent_device, parent_inode, scan_time, basename, stat, root_inode, seq=None
+):
     return (
         stat.st_ino,
         parent_device,
@@ -37,8 +187,9 @@ def scan_entry(parent_device, parent_inode, scan_time, basename, stat, ipath):
         stat.st_atime,
         scan_time,
         basename.decode("utf-8", "backslashreplace"),
-        ipath[0],
-        ipath[-2] if len(ipath) >= 2 else None,
+        root_inode,
+        parent_inode,
+        seq,
     )
 
 
@@ -54,23 +205,945 @@ unreadable_stat = types.SimpleNamespace(
 )
 
 
-def scan(path, scan_time, parent_device, parent_inode, ipath):
+class CsvWriter:
+    """
+    Writes scanned rows to a binary file as utf-8 csv, in batches of
+    `batch_size`
+    """
+
+    extension = "csv"
+    trailer = b""
+    column_types = column_types
+
+    def __init__(self, f, batch_size=10000):
+        self.f = f
+        self.batch_size = batch_size
+        self.batch = io.StringIO()
+        self.writer = csv.writer(self.batch)
+        self.count = 0
+
+    @staticmethod
+    def prepare(row):
+        # bytea columns need to be in hex format
+        if row[12] is None:
+            return row
+        return row[:12] + ("\\x" + row[12].hex(),)
+
+    def writerow(self, row):
+        self.writer.writerow(self.prepare(row))
+        self.count += 1
+        if self.count >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        rows = map(self.prepare, rows)
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if len(batch) == 0:
+                return
+            self.writer.writerows(batch)
+            self.flush()
+
+    def flush(self):
+        self.f.write(self.batch.getvalue().encode("utf-8", "surrogateescape"))
+        self.batch.seek(0)
+        self.batch.truncate()
+        self.count = 0
+
+    def checkpoint(self):
+        self.flush()
+        return self.f.checkpoint()
+
+    def rollback(self):
+        self.batch.seek(0)
+        self.batch.truncate()
+        self.count = 0
+        self.f.rollback()
+
+    def finish(self):
+        self.flush()
+        self.f.flush()
+
+    @classmethod
+    def read(cls, f):
+        """
+        Read rows back from a binary csv file
+        """
+        f = io.TextIOWrapper(f, encoding="utf-8", errors="surrogateescape", newline="")
+        for row in csv.reader(f):
+            yield tuple(
+                None if v == "" else t(v) for t, v in zip(cls.column_types, row)
+            )
+
+
+class BinaryWriter:
+    """
+    Writes scanned rows to a binary file in PostgreSQL's binary COPY format
+
+    This is both smaller and quicker to write than csv, since numbers don't
+    need to be formatted, and can be loaded directly with ``COPY ... WITH
+    (FORMAT BINARY)``. Rows are packed in batches of `batch_size` to keep the
+    number of writes down.
+
+    Each file has a header and trailer, so unlike csv files they can't just be
+    concatenated together.
+    """
+
+    extension = "bin"
+
+    signature = b"PGCOPY\n\xff\r\n\0"
+    header = signature + struct.pack(">ii", 0, 0)
+    trailer = struct.pack(">h", -1)
+
+    # Postgres type of each column as a struct format, None for text and
+    # "bytea" for bytes
+    field_formats = (
+        "q",
+        "q",
+        "i",
+        "i",
+        "i",
+        "q",
+        "d",
+        "d",
+        "d",
+        None,
+        "q",
+        "q",
+        "bytea",
+    )
+
+    # Packs the fields before and after basename for rows without nulls
+    head = struct.Struct(">h" + "".join(f"i{t}" for t in field_formats[:9]) + "i")
+    tail = struct.Struct(">" + "".join(f"i{t}" for t in field_formats[10:12]) + "i")
+
+    def __init__(self, f, batch_size=10000):
+        self.f = f
+        self.batch_size = batch_size
+        self.batch = []
+
+        self.fields = [
+            struct.Struct(f">i{t}") if t not in (None, "bytea") else None
+            for t in self.field_formats
+        ]
+
+        self.f.write(self.header)
+
+    def pack(self, row):
+        if None in row:
+            return self.pack_nulls(row)
+
+        name = row[9].encode("utf-8", "surrogateescape")
+        return b"".join(
+            [
+                self.head.pack(
+                    len(row),
+                    8,
+                    row[0],
+                    8,
+                    row[1],
+                    4,
+                    row[2],
+                    4,
+                    row[3],
+                    4,
+                    row[4],
+                    8,
+                    row[5],
+                    8,
+                    row[6],
+                    8,
+                    row[7],
+                    8,
+                    row[8],
+                    len(name),
+                ),
+                name,
+                self.tail.pack(8, row[10], 8, row[11], len(row[12])),
+                row[12],
+            ]
+        )
+
+    def pack_nulls(self, row):
+        out = [struct.pack(">h", len(row))]
+        for t, field, value in zip(self.field_formats, self.fields, row):
+            if value is None:
+                out.append(struct.pack(">i", -1))
+            elif field is None:
+                if t is None:
+                    value = value.encode("utf-8", "surrogateescape")
+                out.append(struct.pack(">i", len(value)))
+                out.append(value)
+            else:
+                out.append(field.pack(field.size - 4, value))
+        return b"".join(out)
+
+    def writerow(self, row):
+        self.batch.append(self.pack(row))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        self.f.write(b"".join(self.batch))
+        self.batch = []
+
+    def checkpoint(self):
+        self.flush()
+        return self.f.checkpoint()
+
+    def rollback(self):
+        self.batch = []
+        self.f.rollback()
+
+    def finish(self):
+        self.flush()
+        self.f.write(self.trailer)
+        self.f.flush()
+
+    @classmethod
+    def read(cls, f):
+        """
+        Read rows back from a binary file
+        """
+        header = f.read(len(cls.header))
+        if header[: len(cls.signature)] != cls.signature:
+            raise ValueError("Not a binary scan file")
+
+        fields = [
+            struct.Struct(f">{t}") if t not in (None, "bytea") else t
+            for t in cls.field_formats
+        ]
+        int16 = struct.Struct(">h")
+        int32 = struct.Struct(">i")
+
+        while True:
+            (count,) = int16.unpack(f.read(2))
+            if count == -1:
+                return
+
+            row = []
+            for field in fields[:count]:
+                (size,) = int32.unpack(f.read(4))
+                if size == -1:
+                    row.append(None)
+                elif field is None:
+                    row.append(f.read(size).decode("utf-8", "surrogateescape"))
+                elif field == "bytea":
+                    row.append(f.read(size))
+                else:
+                    row.append(field.unpack(f.read(size))[0])
+            yield tuple(row)
+
+
+class RollupCsvWriter(CsvWriter):
+    """
+    Writes rollup rows as csv
+    """
+
+    column_types = rollup_column_types
+
+    @staticmethod
+    def prepare(row):
+        return row
+
+
+class RollupBinaryWriter(BinaryWriter):
+    """
+    Writes rollup rows in PostgreSQL's binary COPY format
+    """
+
+    field_formats = ("q", "q", "q", "i", "i", None, None, "q", "q", "d")
+
+    def pack(self, row):
+        return self.pack_nulls(row)
+
+
+# Available output formats
+writers = {"csv": CsvWriter, "binary": BinaryWriter}
+rollup_writers = {"csv": RollupCsvWriter, "binary": RollupBinaryWriter}
+
+
+class ShardFile:
+    """
+    An output file that can be checkpointed, so that after a crash it can be
+    truncated back to the last checkpoint
+
+    If `offset` is given an existing file is truncated to that offset and
+    appended to. With `compress` each checkpoint ends a gzip member, so
+    truncating at a checkpoint still leaves a valid gzip file.
+    """
+
+    def __init__(self, path, compress=False, offset=None):
+        self.compress = compress
+        self.gz = None
+
+        if offset is None:
+            self.raw = open(path, "wb")
+        else:
+            self.raw = open(path, "r+b")
+            self.raw.truncate(offset)
+            self.raw.seek(offset)
+
+        self.offset = self.raw.tell()
+
+    def write(self, data):
+        if not self.compress:
+            self.raw.write(data)
+            return
+
+        if self.gz is None:
+            self.gz = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=1)
+        self.gz.write(data)
+
+    def end_member(self):
+        if self.gz is not None:
+            self.gz.close()
+            self.gz = None
+
+    def flush(self):
+        if self.gz is not None:
+            self.gz.flush()
+        self.raw.flush()
+
+    def checkpoint(self):
+        """
+        Make sure everything written so far is on disk
+
+        Returns the offset that the file can be truncated back to
+        """
+        self.end_member()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.offset = self.raw.tell()
+        return self.offset
+
+    def rollback(self):
+        """
+        Discard everything written since the last checkpoint
+        """
+        self.end_member()
+        self.raw.flush()
+        self.raw.truncate(self.offset)
+        self.raw.seek(self.offset)
+
+    def close(self):
+        self.end_member()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CopyWriter:
+    """
+    Streams scanned rows straight into a PostgreSQL table with COPY
+
+    Rows are sent in binary format through a pipe to a thread running the
+    COPY, so loading happens while the scan is still running. The rows are
+    committed at each :meth:`checkpoint` and by :meth:`finish`.
+    """
+
+    def __init__(
+        self,
+        url,
+        table="dusql_inode_load",
+        batch_size=10000,
+        columns=columns,
+        Writer=BinaryWriter,
+    ):
+        import psycopg2
+
+        self.conn = psycopg2.connect(url)
+        self.table = table
+        self.batch_size = batch_size
+        self.columns = columns
+        self.Writer = Writer
+
+        self.start()
+
+    def start(self):
+        """
+        Start a new COPY
+        """
+        self.error = None
+
+        read_fd, write_fd = os.pipe()
+        self.pipe = os.fdopen(write_fd, "wb")
+        self.writer = self.Writer(self.pipe, self.batch_size)
+
+        self.thread = threading.Thread(
+            target=self.copy, args=(os.fdopen(read_fd, "rb"),), daemon=True
+        )
+        self.thread.start()
+
+    def copy(self, f):
+        try:
+            with self.conn.cursor() as cur:
+                cur.copy_expert(
+                    f"COPY {self.table}({', '.join(self.columns)}) FROM STDIN WITH (FORMAT BINARY)",
+                    f,
+                )
+        except Exception as e:
+            self.error = e
+        finally:
+            # Stops the writer blocking if the copy failed
+            f.close()
+
+    def writerow(self, row):
+        try:
+            self.writer.writerow(row)
+        except BrokenPipeError:
+            self.raise_error()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        try:
+            self.writer.flush()
+        except BrokenPipeError:
+            self.raise_error()
+
+    def raise_error(self):
+        self.thread.join()
+        raise Exception(f"COPY failed: {self.error}") from self.error
+
+    def end(self):
+        """
+        Finish the current COPY, raising any errors
+        """
+        try:
+            self.writer.finish()
+            self.pipe.close()
+        except BrokenPipeError:
+            self.raise_error()
+
+        self.thread.join()
+        if self.error is not None:
+            self.raise_error()
+
+    def close_pipe(self):
+        try:
+            self.pipe.close()
+        except BrokenPipeError:
+            pass
+        self.thread.join()
+
+    def checkpoint(self):
+        self.end()
+        self.conn.commit()
+        self.start()
+
+    def rollback(self):
+        """
+        Discard rows sent since the last checkpoint
+        """
+        self.close_pipe()
+        self.conn.rollback()
+        self.start()
+
+    def finish(self):
+        self.end()
+        self.conn.commit()
+        self.conn.close()
+
+    def abort(self):
+        """
+        Stop the COPY without committing anything more
+        """
+        self.close_pipe()
+        self.conn.close()
+
+
+class Output:
+    """
+    Where scanned rows get written to, either files in `output_format` or if
+    `copy_to` is a database url then a COPY stream into `copy_table`
+
+    If `rollup` is True the scan also writes per-directory totals (see
+    :class:`Rollup`), which get copied into `copy_rollup_table`
+    """
+
+    def __init__(
+        self,
+        output_format="csv",
+        compress=False,
+        copy_to=None,
+        copy_table="dusql_inode_load",
+        rollup=False,
+        copy_rollup_table="dusql_dir_rollup_load",
+    ):
+        self.output_format = output_format
+        self.compress = compress
+        self.copy_to = copy_to
+        self.copy_table = copy_table
+        self.rollup = rollup
+        self.copy_rollup_table = copy_rollup_table
+
+    def name(self, prefix):
+        """
+        File name for output starting with `prefix`
+        """
+        name = f"{prefix}.{writers[self.output_format].extension}"
+        if self.compress:
+            name += ".gz"
+        return name
+
+    @contextlib.contextmanager
+    def open(self, path, rollup=False):
+        """
+        Get a writer for the file `path` ('-' for stdout), which is finished
+        once the context closes. With `rollup` the writer is for rollup rows.
+
+        `path` is ignored when copying to a database
+        """
+        if self.copy_to is not None:
+            if rollup:
+                writer = CopyWriter(
+                    self.copy_to,
+                    self.copy_rollup_table,
+                    columns=rollup_columns,
+                    Writer=RollupBinaryWriter,
+                )
+            else:
+                writer = CopyWriter(self.copy_to, self.copy_table)
+            try:
+                yield writer
+            except BaseException:
+                writer.abort()
+                raise
+            writer.finish()
+            return
+
+        Writer = (rollup_writers if rollup else writers)[self.output_format]
+        if path == "-":
+            if self.compress:
+                raise ValueError("Compressed output needs a file")
+            f = contextlib.nullcontext(sys.stdout.buffer)
+        else:
+            f = ShardFile(path, self.compress)
+
+        with f as f:
+            writer = Writer(f)
+            try:
+                yield writer
+            finally:
+                writer.finish()
+
+
+def scan_format(path):
+    """
+    Work out the format of the scan output file `path`
+
+    Returns (opener, output_format), where `opener` opens the file to read the
+    uncompressed data
+    """
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+
+    opener = gzip.open if compressed else open
+
+    with opener(path, "rb") as f:
+        binary = f.read(len(BinaryWriter.signature)) == BinaryWriter.signature
+
+    return opener, "binary" if binary else "csv"
+
+
+def read_scan(path, rollup=False):
+    """
+    Read the rows from a scan output file in any format, or with `rollup` a
+    rollup output file
+    """
+    opener, output_format = scan_format(path)
+
+    Writer = (rollup_writers if rollup else writers)[output_format]
+    with opener(path, "rb") as f:
+        yield from Writer.read(f)
+
+
+class PreviousScan:
+    """
+    The results of an earlier scan, used to skip re-scanning directories that
+    haven't changed since
+
+    The rows are stored in a sqlite database at `path` so that large scans
+    don't need to fit in memory, and the database can be shared between
+    processes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @classmethod
+    def build(cls, path, shards):
+        """
+        Create the database at `path` from the scan output files `shards`
+        """
+        db = sqlite3.connect(path)
+        db.execute(f"CREATE TABLE inode ({', '.join(columns)})")
+
+        for shard in shards:
+            # Scans from before `seq` was added don't have it
+            db.executemany(
+                f"INSERT INTO inode VALUES ({', '.join('?' * len(columns))})",
+                ((row + (None,))[: len(columns)] for row in read_scan(shard)),
+            )
+
+        db.execute("CREATE INDEX inode_id ON inode(device, inode)")
+        db.execute("CREATE INDEX inode_parent ON inode(device, parent_inode)")
+        db.commit()
+        db.close()
+
+        return cls(path)
+
+    @property
+    def db(self):
+        # sqlite connections can't be shared between threads or processes
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            local.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            local.pid = os.getpid()
+        return local.db
+
+    def unchanged(self, directory):
+        """
+        Get the previous contents of `directory` if it hasn't changed
+
+        Returns a dict of rows keyed by inode, or None if the directory is new
+        or has been modified since the previous scan
+        """
+        old = self.db.execute(
+            "SELECT mtime, scan_time FROM inode WHERE device = ? AND inode = ?",
+            (directory.device, directory.inode),
+        ).fetchone()
+
+        if old is None or old[0] != directory.mtime:
+            return None
+
+        # Timestamps are only to the second, so a change made in the same
+        # second the old scan started may not show up in the mtime
+        if directory.mtime >= old[1] - 1:
+            return None
+
+        rows = self.db.execute(
+            "SELECT * FROM inode WHERE device = ? AND parent_inode = ?",
+            (directory.device, directory.inode),
+        )
+        return {row[0]: row for row in rows}
+
+
+def write_delta(previous, current, insert_writer, delete_writer):
+    """
+    Write the changes from the :class:`PreviousScan` `previous` to `current`
+
+    Rows in `current` that are new or have changed are written to
+    `insert_writer`, and the rows in `previous` that have changed or no
+    longer exist to `delete_writer`, so applying the delta replaces the old
+    version of a changed row with the new one. Rows are compared as a whole,
+    rather than by (device, inode), since hard links and overlapping roots
+    give the same inode more than one row.
+    """
+    db = sqlite3.connect(f"file:{current.path}?mode=ro", uri=True)
+    db.execute("ATTACH DATABASE ? AS previous", (f"file:{previous.path}?mode=ro",))
+
+    # scan_time changes every scan even if nothing else does, as does the
+    # atime of directories, since the scan itself reads them
+    same = " AND ".join(
+        f"a.{c} IS b.{c}" for c in columns if c not in ("scan_time", "atime")
+    )
+    same += " AND (a.atime IS b.atime OR a.mode & 61440 = 16384)"
+
+    def unmatched(a, b):
+        return db.execute(
+            f"""
+            SELECT a.* FROM {a}.inode AS a
+            WHERE NOT EXISTS (SELECT 1 FROM {b}.inode AS b WHERE {same})
+            """
+        )
+
+    insert_writer.writerows(unmatched("main", "previous"))
+    delete_writer.writerows(unmatched("previous", "main"))
+
+    db.close()
+
+
+def scan_delta(previous, shards, delta_dir, output, tmpdir):
+    """
+    Write the changes since `previous` in the scan output files `shards` to
+    'dusql_insert' and 'dusql_delete' files in `delta_dir`
+    """
+    path = os.path.join(tmpdir, "current.sqlite")
+    if os.path.exists(path):
+        # Left over from an earlier attempt
+        os.remove(path)
+    current = PreviousScan.build(path, shards)
+
+    os.makedirs(delta_dir, exist_ok=True)
+    with output.open(
+        os.path.join(delta_dir, output.name("dusql_insert"))
+    ) as insert_writer, output.open(
+        os.path.join(delta_dir, output.name("dusql_delete"))
+    ) as delete_writer:
+        write_delta(previous, current, insert_writer, delete_writer)
+
+
+# A directory waiting to be scanned. This is all the context needed to scan
+# its contents, so the cost of each entry doesn't depend on its depth.
+# `ancestors` is a linked list of the parent directories' inodes as nested
+# (inode, ancestors) pairs, so it can be extended without copying. `seq` is
+# the directory's pre-order key, see :func:`seq_key`
+Directory = collections.namedtuple(
+    "Directory",
+    [
+        "path",
+        "scan_time",
+        "device",
+        "inode",
+        "root_inode",
+        "mtime",
+        "seq",
+        "ancestors",
+    ],
+    defaults=(b"", ()),
+)
+
+
+def ancestors(directory):
+    """
+    Inodes of the directories above `directory`, nearest first
+    """
+    a = directory.ancestors
+    while len(a) > 0:
+        yield a[0]
+        a = a[1]
+
+
+def ancestors_from_list(inodes):
+    """
+    Convert a list of inodes, nearest first, to a :class:`Directory`'s
+    `ancestors`
+    """
+    a = ()
+    for inode in reversed(inodes):
+        a = (inode, a)
+    return a
+
+
+def rollup_key(row, scan_time):
+    """
+    The uid, gid and age bins `row` is totalled by in a scan started at
+    `scan_time`
+    """
+    return (
+        row[3],
+        row[4],
+        age_label(row[6], age_bins(scan_time, history_ages)),
+        age_label(row[7], age_bins(scan_time, access_ages)),
+    )
+
+
+def rollup_row(row, directory):
+    """
+    The rollup row counting a directory's own `row`, from the scan of
+    `directory`, in its total
+    """
+    return (
+        (row[1], row[0], directory.root_inode)
+        + rollup_key(row, directory.scan_time)
+        + (1, row[5] or 0, row[6])
+    )
+
+
+class Rollup:
+    """
+    Totals up the size, number of inodes and latest mtime under each
+    directory as the scan of `root` unwinds, writing them to `writer` with
+    columns :data:`rollup_columns`
+
+    Totals are split by uid, gid and how long ago files were modified and
+    accessed, see :data:`history_ages` and :data:`access_ages`.
+
+    A directory's total includes the directory itself. Subdirectories given
+    away to other processes are totalled by those processes, which also write
+    rows adding their totals on to each of their ancestors, so rows for the
+    same directory and key need to be summed when they are loaded.
+
+    Only directories that are still being scanned are kept in memory. If
+    `root_row` is given the root's own row is counted in its total, otherwise
+    it should be written separately with :func:`rollup_row`.
+    """
+
+    def __init__(self, writer, root, root_row=None):
+        self.writer = writer
+        self.root = root
+
+        # inode -> [totals, subdirectories still being scanned, listing done, parent inode]
+        self.nodes = {}
+
+        if root_row is not None:
+            self.add(root, root_row)
+
+    def node(self, inode):
+        node = self.nodes.get(inode)
+        if node is None:
+            node = self.nodes[inode] = [{}, 0, False, None]
+        return node
+
+    def count(self, totals, row):
+        key = rollup_key(row, self.root.scan_time)
+        t = totals.get(key)
+        if t is None:
+            totals[key] = [1, row[5] or 0, row[6]]
+            return
+
+        t[0] += 1
+        t[1] += row[5] or 0
+        if row[6] is not None and (t[2] is None or row[6] > t[2]):
+            t[2] = row[6]
+
+    @staticmethod
+    def merge(totals, other):
+        for key, o in other.items():
+            t = totals.get(key)
+            if t is None:
+                totals[key] = o
+                continue
+
+            t[0] += o[0]
+            t[1] += o[1]
+            if o[2] is not None and (t[2] is None or o[2] > t[2]):
+                t[2] = o[2]
+
+    def add(self, directory, row):
+        """
+        Count `row` from the contents of `directory`
+        """
+        self.count(self.node(directory.inode)[0], row)
+
+    def descend(self, directory, row, subdir):
+        """
+        `subdir`, with directory row `row`, from the contents of `directory`
+        is going to be scanned by this process
+        """
+        self.node(directory.inode)[1] += 1
+
+        node = self.node(subdir.inode)
+        node[3] = directory.inode
+        self.count(node[0], row)
+
+    def donated(self, directory, row):
+        """
+        The subdirectory with directory row `row` from the contents of
+        `directory` is going to be scanned by another process
+        """
+        self.add(directory, row)
+        # The other process will only count the directory's contents
+        self.writer.writerow(rollup_row(row, directory))
+
+    def listed(self, directory):
+        """
+        Everything in `directory` has been counted, its total is complete
+        once all of its subdirectories are done
+        """
+        inode = directory.inode
+        node = self.node(inode)
+        node[2] = True
+
+        while node[2] and node[1] == 0:
+            del self.nodes[inode]
+            self.write(inode, node[0])
+
+            if inode == self.root.inode:
+                # Add this part of the tree on to the directories above it
+                for a in ancestors(self.root):
+                    self.write(a, node[0])
+                return
+
+            parent = self.nodes[node[3]]
+            self.merge(parent[0], node[0])
+            parent[1] -= 1
+
+            inode, node = node[3], parent
+
+    def write(self, inode, totals):
+        prefix = (self.root.device, inode, self.root.root_inode)
+        self.writer.writerows(prefix + key + tuple(t) for key, t in totals.items())
+
+
+def scan_directory(directory, previous=None):
+    """
+    Scan the immediate contents of a single directory
+
+    Yields (row, subdir) for each entry, where subdir is a :class:`Directory`
+    if the entry is a directory on the same device that should be descended
+    into, otherwise None
+
+    If `previous` is a :class:`PreviousScan` and the directory hasn't changed
+    since then the old rows of files are reused rather than calling stat()
+    on them again. Subdirectories are still checked, since changes inside
+    them don't affect the mtime of this directory.
+    """
+    reuse = None
+    if previous is not None:
+        reuse = previous.unchanged(directory)
 
     try:
-        with os.scandir(path) as it:
+        # Listing through a file descriptor means stat() on each entry is
+        # relative to the directory, rather than looking up the full path
+        fd = os.open(directory.path, os.O_RDONLY | os.O_DIRECTORY)
+    except PermissionError:
+        return
+    except FileNotFoundError:
+        return
+
+    try:
+        with os.scandir(fd) as it:
             for entry in it:
                 inode = entry.inode()
-                entry_ipath = ipath + [inode]
+                seq = directory.seq + seq_key(inode)
+
+                if (
+                    reuse is not None
+                    and inode in reuse
+                    and not entry.is_dir(follow_symlinks=False)
+                ):
+                    # The directory may have moved, possibly to another root
+                    row = reuse[inode]
+                    yield (
+                        row[:1]
+                        + (directory.device,)
+                        + row[2:10]
+                        + (directory.root_inode, directory.inode, seq)
+                    ), None
+                    continue
+
+                subdir = None
 
                 try:
                     stat = entry.stat(follow_symlinks=False)
 
                     if (
                         entry.is_dir(follow_symlinks=False)
-                        and parent_device == stat.st_dev
+                        and directory.device == stat.st_dev
                     ):
-                        yield from scan(
-                            entry.path, scan_time, stat.st_dev, stat.st_ino, entry_ipath
+                        subdir = Directory(
+                            os.path.join(directory.path, os.fsencode(entry.name)),
+                            directory.scan_time,
+                            stat.st_dev,
+                            inode,
+                            directory.root_inode,
+                            stat.st_mtime,
+                            seq,
+                            (directory.inode, directory.ancestors),
                         )
 
                 except (PermissionError, OSError):
@@ -78,77 +1151,786 @@ def scan(path, scan_time, parent_device, parent_inode, ipath):
                 except FileNotFoundError:
                     continue
 
-                yield scan_entry(
-                    parent_device=parent_device,
-                    parent_inode=parent_inode,
-                    scan_time=scan_time,
-                    basename=entry.name,
-                    stat=stat,
-                    ipath=entry_ipath,
+                yield (
+                    scan_entry(
+                        parent_device=directory.device,
+                        parent_inode=directory.inode,
+                        scan_time=directory.scan_time,
+                        basename=os.fsencode(entry.name),
+                        stat=stat,
+                        root_inode=directory.root_inode,
+                        seq=seq,
+                    ),
+                    subdir,
                 )
 
     except PermissionError:
         return
-        # yield scan_entry(
-        #        parent_device = parent_device,
-        #        parent_inode = parent_inode,
-        #        scan_time = scan_time,
-        #        basename = b'',
-        #        stat = unreadable_stat,
-        #        ipath = ipath)
     except FileNotFoundError:
         return
+    finally:
+        os.close(fd)
+
+
+def scan(path, scan_time, parent_device, parent_inode, ipath):
+    """
+    Recursively scan `path`, yielding the directory contents depth first
+    """
+    stat = os.stat(path)
+    yield from scan_serial(
+        Directory(path, scan_time, parent_device, parent_inode, ipath[0], stat.st_mtime)
+    )
+
+
+def scan_serial(directory, donate=None, previous=None, rollup=None):
+    """
+    Recursively scan `directory` depth first
+
+    A directory's row comes after all of its contents. Rather than recursing,
+    the directories being scanned are kept on an explicit stack, so deep trees
+    don't hit the recursion limit or pay to pass each row up through a
+    generator for every level.
+
+    If `donate` is given it is called with each subdirectory, if it returns
+    True the subdirectory is assumed to be scanned elsewhere and is skipped.
+    `previous` is passed on to :func:`scan_directory`. If `rollup` is a
+    :class:`Rollup` every row is counted in its totals.
+    """
+    # (contents iterator, row for the directory itself, directory)
+    stack = [(scan_directory(directory, previous), None, directory)]
+
+    while len(stack) > 0:
+        contents, dir_row, current = stack[-1]
+
+        for row, subdir in contents:
+            if subdir is not None:
+                if donate is None or not donate(subdir):
+                    if rollup is not None:
+                        rollup.descend(current, row, subdir)
+                    stack.append((scan_directory(subdir, previous), row, subdir))
+                    break
+                if rollup is not None:
+                    rollup.donated(current, row)
+            elif rollup is not None:
+                rollup.add(current, row)
+            yield row
+
+        else:
+            # Finished this directory
+            stack.pop()
+            if rollup is not None:
+                rollup.listed(current)
+            if dir_row is not None:
+                yield dir_row
+
+
+def scan_parallel(directory, workers, donate=None, previous=None, rollup=None):
+    """
+    Recursively scan `directory` using a pool of `workers` threads
+
+    Each thread takes a directory from a shared queue, scans its contents and
+    adds any subdirectories back to the queue. Rows are yielded in the order
+    that directories are completed, so will be the same as :func:`scan` but
+    in a different order.
+
+    `donate`, `previous` and `rollup` are handled the same as in
+    :func:`scan_serial`
+    """
+    todo = queue.Queue()
+    results = queue.Queue(maxsize=workers * 64)
+
+    def worker():
+        while True:
+            directory = todo.get()
+            if directory is None:
+                return
+            try:
+                rows = []
+                subdirs = []
+                donated = []
+                for row, subdir in scan_directory(directory, previous):
+                    if subdir is not None:
+                        if donate is None or not donate(subdir):
+                            subdirs.append((row, subdir))
+                        else:
+                            donated.append(row)
+                    else:
+                        rows.append(row)
+
+                # Subdirectories only get queued after their parent's results,
+                # so the parent is always counted first by the rollup
+                results.put((directory, rows, subdirs, donated))
+                for row, subdir in subdirs:
+                    todo.put(subdir)
+            except Exception as e:
+                # Pass errors on to be raised in the main thread
+                results.put(e)
+            finally:
+                todo.task_done()
 
+    def finished():
+        # Signal the consumer once every queued directory has been scanned
+        todo.join()
+        results.put(None)
 
-def scan_root(root_path, csvwriter):
+    todo.put(directory)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    threads.append(threading.Thread(target=finished, daemon=True))
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            if isinstance(result, Exception):
+                raise result
+
+            directory, rows, subdirs, donated = result
+            if rollup is not None:
+                for row in rows:
+                    rollup.add(directory, row)
+                for row in donated:
+                    rollup.donated(directory, row)
+                for row, subdir in subdirs:
+                    rollup.descend(directory, row, subdir)
+                rollup.listed(directory)
+
+            yield from rows
+            yield from donated
+            for row, subdir in subdirs:
+                yield row
+    finally:
+        for _ in range(workers):
+            todo.put(None)
+
+
+def scan_tree(directory, workers=1, donate=None, previous=None, rollup=None):
+    """
+    Recursively scan `directory`, using threads if `workers` is more than 1
+    """
+    if workers > 1:
+        return scan_parallel(directory, workers, donate, previous, rollup)
+    else:
+        return scan_serial(directory, donate, previous, rollup)
+
+
+def root_directory(root_path, index=0):
+    """
+    Stat a root path to start scanning from, the `index`-th root of the scan
+
+    Returns (row, directory) with the row for the root itself and the
+    :class:`Directory` to scan, or None if the root doesn't exist
+    """
     broot_path = root_path.encode("utf-8")
 
     try:
         stat = os.stat(root_path)
     except FileNotFoundError:
-        return
+        return None
 
     scan_time = time.time()
-    ipath = [stat.st_ino]
-
-    csvwriter.writerow(
-        scan_entry(
-            parent_device=stat.st_dev,
-            parent_inode=None,
-            scan_time=scan_time,
-            basename=broot_path,
-            stat=stat,
-            ipath=ipath,
-        )
+    seq = seq_key(index)
+
+    row = scan_entry(
+        parent_device=stat.st_dev,
+        parent_inode=None,
+        scan_time=scan_time,
+        basename=broot_path,
+        stat=stat,
+        root_inode=stat.st_ino,
+        seq=seq,
     )
 
-    csvwriter.writerows(
-        tqdm.tqdm(
-            scan(
-                broot_path,
-                scan_time=scan_time,
-                parent_device=stat.st_dev,
-                parent_inode=stat.st_ino,
-                ipath=ipath,
-            ),
-            desc=root_path,
-            disable=None,
-        )
+    return (
+        row,
+        Directory(
+            broot_path,
+            scan_time,
+            stat.st_dev,
+            stat.st_ino,
+            stat.st_ino,
+            stat.st_mtime,
+            seq,
+        ),
     )
 
 
+def scan_root(root_path, writer, workers=1, previous=None, rollup_writer=None, index=0):
+    root = root_directory(root_path, index)
+    if root is None:
+        return
+
+    row, directory = root
+    writer.writerow(row)
+
+    rollup = None
+    if rollup_writer is not None:
+        rollup = Rollup(rollup_writer, directory, row)
+
+    rows = scan_tree(directory, workers, previous=previous, rollup=rollup)
+    writer.writerows(tqdm.tqdm(rows, desc=root_path, disable=None))
+
+
+class WorkPool:
+    """
+    A queue of directories to scan shared between processes
+
+    The queue is a directory on a shared filesystem, so processes on
+    different nodes of a PBS job can all work on the same set of roots. Each
+    waiting subtree is a file in ``pending/``, which is claimed by renaming it
+    into ``claimed/`` and moved to ``done/`` once the whole subtree has been
+    scanned.
+
+    While scanning a process gives away subdirectories to the queue whenever
+    it is running low, so large trees get split between all the processes.
+    Once a subtree has been running for `checkpoint_interval` seconds it gives
+    away all its remaining subdirectories, so that it finishes soon and its
+    output can be checkpointed.
+
+    The queue also works as a checkpoint of the scan. Each process records the
+    size of its output file in ``checkpoints/`` after finishing a subtree, so
+    if a scan gets killed :meth:`recover` can truncate the output back to the
+    last checkpoint and return any unfinished subtrees to the queue.
+    """
+
+    def __init__(self, path, low_water=16, interval=1.0, checkpoint_interval=300):
+        self.path = path
+        self.low_water = low_water
+        self.interval = interval
+        self.checkpoint_interval = checkpoint_interval
+
+        self.pending = os.path.join(path, "pending")
+        self.claimed = os.path.join(path, "claimed")
+        self.done_dir = os.path.join(path, "done")
+        self.checkpoints = os.path.join(path, "checkpoints")
+        self.seeded = os.path.join(path, "seeded")
+        self.previous = os.path.join(path, "previous.sqlite")
+
+        for d in [self.pending, self.claimed, self.done_dir, self.checkpoints]:
+            os.makedirs(d, exist_ok=True)
+
+        # Include some randomness, in case a resumed scan reuses a pid
+        self.prefix = f"{socket.gethostname()}.{os.getpid()}.{os.urandom(3).hex()}"
+        self.counter = itertools.count()
+
+        self._pending_count = 0
+        self._pending_time = 0
+        self.claim_time = time.time()
+
+    def write_item(self, name, item):
+        tmp = os.path.join(self.pending, "." + name)
+        with open(tmp, "w") as f:
+            json.dump(item, f)
+
+        # Only make the item visible once it's completely written
+        os.rename(tmp, os.path.join(self.pending, name))
+
+    def read_item(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, directory, donor=None):
+        """
+        Add a directory to the queue
+
+        `donor` is the name of the item being scanned when `directory` was
+        found, so that if the donor needs to be re-scanned it knows to skip
+        `directory`
+        """
+        d = directory._asdict()
+        d["path"] = os.fsdecode(directory.path)
+        d["seq"] = directory.seq.hex()
+        d["ancestors"] = list(ancestors(directory))
+
+        self.write_item(
+            f"{self.prefix}.{next(self.counter)}.json",
+            {"directory": d, "donor": donor, "skip": []},
+        )
+        self._pending_count += 1
+
+    def claim(self):
+        """
+        Take a directory from the queue
+
+        Returns (name, directory, skip), or None if nothing is pending. `skip`
+        is a set of inodes of subdirectories that have already been given
+        away by an earlier attempt at this directory
+        """
+        names = [n for n in os.listdir(self.pending) if not n.startswith(".")]
+        random.shuffle(names)
+
+        for name in names:
+            claimed = os.path.join(self.claimed, name)
+            try:
+                os.rename(os.path.join(self.pending, name), claimed)
+            except FileNotFoundError:
+                # Another process got there first
+                continue
+
+            item = self.read_item(claimed)
+            d = item["directory"]
+            d["path"] = os.fsencode(d["path"])
+            d["seq"] = bytes.fromhex(d["seq"])
+            d["ancestors"] = ancestors_from_list(d["ancestors"])
+
+            self.claim_time = time.time()
+            return name, Directory(**d), set(item["skip"])
+
+        return None
+
+    def done(self, name):
+        """
+        Mark a claimed directory as completely scanned
+        """
+        os.rename(os.path.join(self.claimed, name), os.path.join(self.done_dir, name))
+
+    def donations(self):
+        """
+        Inodes of directories given away by each item, keyed by the item name
+        """
+        donated = collections.defaultdict(set)
+        for d in [self.pending, self.claimed, self.done_dir]:
+            for name in os.listdir(d):
+                if name.startswith("."):
+                    continue
+                item = self.read_item(os.path.join(d, name))
+                if item["donor"] is not None:
+                    donated[item["donor"]].add(item["directory"]["inode"])
+        return donated
+
+    def release(self, name, donations=None):
+        """
+        Return a claimed directory to the queue, to be scanned again from the
+        start apart from any subdirectories it has already given away
+        """
+        if donations is None:
+            donations = self.donations()
+
+        claimed = os.path.join(self.claimed, name)
+        item = self.read_item(claimed)
+        item["skip"] = sorted(set(item["skip"]) | donations.get(name, set()))
+
+        self.write_item(name, item)
+        os.unlink(claimed)
+
+    def donate(self, directory, donor=None, skip=frozenset()):
+        """
+        Add `directory` to the queue if the queue is running low or it's
+        time for a checkpoint
+
+        Returns True if the directory should not be scanned by the caller
+        """
+        if directory.inode in skip:
+            # Given away before a restart
+            return True
+
+        now = time.time()
+        if now - self._pending_time > self.interval:
+            self._pending_count = len(os.listdir(self.pending))
+            self._pending_time = now
+
+        if (
+            self._pending_count < self.low_water
+            or now - self.claim_time > self.checkpoint_interval
+        ):
+            self.put(directory, donor)
+            return True
+        return False
+
+    def checkpoint(self, output, files, done=None):
+        """
+        Checkpoint the (writer, path) pairs in `files`, which are writing
+        `output`, after finishing the item `done`
+        """
+        state = {
+            "files": [
+                {
+                    "path": os.path.abspath(path) if output.copy_to is None else None,
+                    "offset": writer.checkpoint(),
+                }
+                for writer, path in files
+            ],
+            "format": output.output_format,
+            "compress": output.compress,
+            "done": done,
+        }
+
+        name = os.path.join(self.checkpoints, os.path.basename(files[0][1]) + ".json")
+        with open(name + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.rename(name + ".tmp", name)
+
+    def recover(self):
+        """
+        Recover from a killed scan, so it can be resumed
+
+        Output files are truncated back to their last checkpoint, and any
+        directories claimed by processes that didn't finish them are returned
+        to the queue. This must only be run while no processes are scanning.
+        """
+        if not os.path.exists(self.seeded):
+            raise Exception(f"Nothing to resume in {self.path}")
+
+        finished = set()
+        for name in os.listdir(self.checkpoints):
+            if not name.endswith(".json"):
+                continue
+
+            state = self.read_item(os.path.join(self.checkpoints, name))
+            finished.add(state["done"])
+
+            for shard in state["files"]:
+                if shard["path"] is None:
+                    continue
+                Writer = writers[state["format"]]
+                with ShardFile(shard["path"], state["compress"], shard["offset"]) as f:
+                    f.write(Writer.trailer)
+
+        donations = self.donations()
+        for name in os.listdir(self.claimed):
+            if name in finished:
+                # Output was checkpointed but the item wasn't marked done
+                self.done(name)
+            else:
+                self.release(name, donations)
+
+    def seed(self, root_paths, writer, previous_shards=(), rollup_writer=None):
+        """
+        Add the roots to be scanned to a new queue, writing their rows with
+        `writer` and their own rollup rows with `rollup_writer`
+
+        If `previous_shards` are given they are indexed for an incremental
+        scan by all processes using the queue
+        """
+        if os.path.exists(self.seeded):
+            raise Exception(f"Work directory {self.path} is already in use")
+
+        if len(previous_shards) > 0:
+            PreviousScan.build(self.previous, previous_shards)
+
+        for index, root_path in enumerate(root_paths):
+            root = root_directory(root_path, index)
+            if root is None:
+                continue
+
+            row, directory = root
+            writer.writerow(row)
+            if rollup_writer is not None:
+                rollup_writer.writerow(rollup_row(row, directory))
+            self.put(directory)
+
+        with open(self.seeded, "w"):
+            pass
+
+    def finished(self):
+        """
+        True once the queue has been seeded and all its work done
+        """
+        return (
+            os.path.exists(self.seeded)
+            and not os.listdir(self.pending)
+            and not os.listdir(self.claimed)
+        )
+
+
+def pool_worker(
+    workdir, output_dir, workers=1, output=Output(), checkpoint_interval=300
+):
+    """
+    Scan directories from the shared queue at `workdir` until all work is
+    done, writing the results to a new file in `output_dir`, and rollups to
+    another if `output.rollup` is set
+    """
+    pool = WorkPool(workdir, checkpoint_interval=checkpoint_interval)
+    path = os.path.join(output_dir, output.name(f"dusql.{pool.prefix}"))
+    rollup_path = os.path.join(output_dir, output.name(f"dusql_rollup.{pool.prefix}"))
+
+    previous = None
+    if os.path.exists(pool.previous):
+        previous = PreviousScan(pool.previous)
+
+    with contextlib.ExitStack() as stack:
+        writer = stack.enter_context(output.open(path))
+        files = [(writer, path)]
+
+        rollup_writer = None
+        if output.rollup:
+            rollup_writer = stack.enter_context(output.open(rollup_path, rollup=True))
+            files.append((rollup_writer, rollup_path))
+
+        pool.checkpoint(output, files)
+
+        while True:
+            item = pool.claim()
+
+            if item is None:
+                if pool.finished():
+                    break
+                # Other processes may still add more work
+                time.sleep(pool.interval)
+                continue
+
+            name, directory, skip = item
+            donate = functools.partial(pool.donate, donor=name, skip=skip)
+
+            rollup = None
+            if rollup_writer is not None:
+                rollup = Rollup(rollup_writer, directory)
+
+            try:
+                writer.writerows(
+                    scan_tree(directory, workers, donate, previous, rollup)
+                )
+                pool.checkpoint(output, files, done=name)
+            except BaseException:
+                # Let another process try, rather than leaving it claimed forever
+                for w, _ in files:
+                    w.rollback()
+                pool.release(name)
+                raise
+            pool.done(name)
+
+
+def scan_pool(
+    root_paths,
+    workdir,
+    output_dir,
+    processes,
+    workers=1,
+    previous_shards=(),
+    output=Output(),
+    resume=False,
+    checkpoint_interval=300,
+):
+    """
+    Scan `root_paths` using `processes` worker processes sharing the queue at
+    `workdir`
+
+    If `root_paths` is empty this joins a queue already seeded by another
+    process, e.g. one running on the first node of a multi-node job. With
+    `resume` a scan that was killed part way through is continued.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    if resume:
+        WorkPool(workdir).recover()
+
+    elif len(root_paths) > 0:
+        pool = WorkPool(workdir)
+        path = os.path.join(output_dir, output.name(f"dusql.{pool.prefix}.roots"))
+        rollup_path = os.path.join(
+            output_dir, output.name(f"dusql_rollup.{pool.prefix}.roots")
+        )
+        with contextlib.ExitStack() as stack:
+            writer = stack.enter_context(output.open(path))
+            rollup_writer = None
+            if output.rollup:
+                rollup_writer = stack.enter_context(
+                    output.open(rollup_path, rollup=True)
+                )
+            pool.seed(root_paths, writer, previous_shards, rollup_writer)
+
+    procs = [
+        multiprocessing.Process(
+            target=pool_worker,
+            args=(workdir, output_dir, workers, output, checkpoint_interval),
+        )
+        for _ in range(processes)
+    ]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+
+    failed = [p.exitcode for p in procs if p.exitcode != 0]
+    if len(failed) > 0:
+        raise Exception(f"{len(failed)} scan processes failed")
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("path", nargs="*")
+    parser.add_argument("--output", "-o", default="-", help="Output file")
+    parser.add_argument(
+        "--format",
+        choices=writers.keys(),
+        default="csv",
+        help="Output format, 'binary' is PostgreSQL's binary COPY format",
+    )
+    parser.add_argument(
+        "--compress", action="store_true", help="Gzip compress the output files"
+    )
+    parser.add_argument(
+        "--workers",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of threads to scan each root with",
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Split the scan between processes sharing this work directory",
+    )
+    parser.add_argument(
+        "--processes",
+        "-p",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Number of processes to use with --workdir",
+    )
     parser.add_argument(
-        "--output", "-o", type=argparse.FileType("w"), default=sys.stdout
+        "--output-dir",
+        help="Directory to write a file per process to with --workdir (default WORKDIR/output)",
+    )
+    parser.add_argument(
+        "--previous",
+        metavar="FILE",
+        action="append",
+        default=[],
+        help="Output of an earlier scan, files in directories that haven't changed since are not re-scanned (may be given multiple times)",
+    )
+    parser.add_argument(
+        "--delta",
+        metavar="DIR",
+        help="Once the scan is done write what changed since --previous to 'dusql_insert.*' and 'dusql_delete.*' files in DIR, for 'dusql-load --merge'",
+    )
+    parser.add_argument(
+        "--copy-to",
+        metavar="URL",
+        help="Stream the results into this database with COPY instead of writing files",
+    )
+    parser.add_argument(
+        "--copy-table",
+        default="dusql_inode_load",
+        help="Table to COPY into with --copy-to (default %(default)s)",
+    )
+    parser.add_argument(
+        "--rollup",
+        action="store_true",
+        help="Also write the total size, inodes and mtime under each directory by uid and gid, to 'dusql_rollup.*' files with --workdir or --copy-rollup-table with --copy-to",
+    )
+    parser.add_argument(
+        "--rollup-output",
+        metavar="FILE",
+        help="Rollup output file when not using --workdir or --copy-to, implies --rollup",
+    )
+    parser.add_argument(
+        "--copy-rollup-table",
+        default="dusql_dir_rollup_load",
+        help="Table to COPY rollups into with --copy-to (default %(default)s)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a scan with --workdir that was killed before finishing",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=300,
+        metavar="SECONDS",
+        help="How often to checkpoint with --workdir (default %(default)s)",
     )
     args = parser.parse_args()
 
-    cf = csv.writer(args.output)
+    if args.compress and args.workdir is None and args.output == "-":
+        parser.error("--compress needs an --output file")
+    if args.resume and (args.workdir is None or len(args.path) > 0):
+        parser.error("--resume needs --workdir and no paths")
+
+    if args.delta is not None:
+        if args.resume:
+            if not os.path.exists(WorkPool(args.workdir).previous):
+                parser.error(
+                    "--delta needs the scan to have been started with --previous"
+                )
+        elif len(args.previous) == 0:
+            parser.error("--delta needs --previous")
+        if args.copy_to is not None:
+            parser.error("--delta can't be used with --copy-to")
+        if args.workdir is None and args.output == "-":
+            parser.error("--delta needs an --output file")
+
+        # Outputs such as --rollup-output may be inside it
+        os.makedirs(args.delta, exist_ok=True)
+
+    rollup = args.rollup or args.rollup_output is not None
+    if (
+        rollup
+        and args.workdir is None
+        and args.copy_to is None
+        and args.rollup_output is None
+    ):
+        parser.error("--rollup needs a --rollup-output file")
+    if args.compress and args.rollup_output == "-":
+        parser.error("--compress needs a --rollup-output file")
+
+    output = Output(
+        args.format,
+        args.compress,
+        args.copy_to,
+        args.copy_table,
+        rollup,
+        args.copy_rollup_table,
+    )
+
+    if args.workdir is not None:
+        output_dir = args.output_dir
+        if output_dir is None:
+            output_dir = os.path.join(args.workdir, "output")
+        scan_pool(
+            args.path,
+            args.workdir,
+            output_dir,
+            args.processes,
+            workers=args.workers,
+            previous_shards=args.previous,
+            output=output,
+            resume=args.resume,
+            checkpoint_interval=args.checkpoint_interval,
+        )
+
+        # Processes that joined another's scan leave the delta to it
+        if args.delta is not None and (len(args.path) > 0 or args.resume):
+            shards = glob.glob(os.path.join(output_dir, "dusql.*"))
+            scan_delta(
+                PreviousScan(WorkPool(args.workdir).previous),
+                shards,
+                args.delta,
+                output,
+                args.workdir,
+            )
+        return
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        previous = None
+        if len(args.previous) > 0:
+            previous = PreviousScan.build(
+                os.path.join(tmpdir, "previous.sqlite"), args.previous
+            )
+
+        with contextlib.ExitStack() as stack:
+            writer = stack.enter_context(output.open(args.output))
+            rollup_writer = None
+            if rollup:
+                rollup_writer = stack.enter_context(
+                    output.open(args.rollup_output, rollup=True)
+                )
+
+            for index, root_path in enumerate(args.path):
+                scan_root(
+                    root_path,
+                    writer,
+                    workers=args.workers,
+                    previous=previous,
+                    rollup_writer=rollup_writer,
+                    index=index,
+                )
 
-    for root_path in args.path:
-        scan_root(root_path, cf)
+        if args.delta is not None:
+            scan_delta(previous, [args.output], args.delta, output, tmpdir)
 
 
 if __name__ == "__main__":
@@ -21,13 +21,15 @@ import grafanadb.model as m
 import sqlalchemy as sa
 from collections.abc import Iterable
 import os
+import stat
+import base64
 
 
-def recursive_search(root_inodes, gid, not_gid, uid, not_uid, mtime, size):
+def roots_query(root_inodes):
     """
-    Perform a recursive search of all files under `root_inodes` with the given constraints
+    Select the (device, inode) pairs in `root_inodes`
     """
-    roots = sa.union_all(
+    return sa.union_all(
         *[
             sa.select(
                 [sa.literal(r[0]).label("device"), sa.literal(r[1]).label("inode")]
@@ -36,74 +38,493 @@ def recursive_search(root_inodes, gid, not_gid, uid, not_uid, mtime, size):
         ]
     ).alias("roots")
 
-    inode = m.Inode.__table__.alias("inode")
-    cte = (
-        sa.select(
-            [
-                *inode.c,
-                sa.func.dusql_path_func(
-                    inode.c.parent_inode, inode.c.device, inode.c.basename
-                ).label("path"),
-            ]
-        ).select_from(
-            inode.join(
-                roots,
-                sa.and_(
-                    inode.c.inode == roots.c.inode, inode.c.device == roots.c.device
-                ),
-            )
-        )
-    ).cte(recursive=True)
 
-    parent = cte.alias("parent")
+# The ages the directory totals are split by, from
+# grafanadb.dusql_scan.history_ages
+ages = ["P0D", "P1M", "P6M", "P1Y", "P3Y"]
 
-    child_paths = cte.union_all(
-        sa.select([*inode.c, (parent.c.path + "/" + inode.c.basename).label("path")])
-        .where(inode.c.parent_inode == parent.c.inode)
-        .where(inode.c.device == parent.c.device)
-    ).alias("find")
 
-    q = sa.select(child_paths.c)
+def age_cutoff(scan_time, age):
+    """
+    The modification time `age` before `scan_time`, matching the boundaries of
+    the rollup ages from :func:`grafanadb.dusql_scan.age_bins`
+    """
+    return sa.extract(
+        "epoch",
+        sa.func.timezone("UTC", sa.func.to_timestamp(scan_time))
+        - sa.cast(sa.literal(age), sa.Interval),
+    )
+
+
+def is_age(mtime):
+    """
+    Is the mtime filter an age like 'P1Y', rather than a timestamp
+    """
+    return isinstance(mtime, str)
+
+
+def recursive_search(
+    root_inodes, gid, not_gid, uid, not_uid, mtime, size, after=None, limit=None
+):
+    """
+    Perform a recursive search of all files under `root_inodes` with the given constraints
+
+    Everything under a root has a `seq` between the root's `seq` and
+    `seq || '\\xff'`, so this is a single index range scan for each root
+    rather than a walk down the tree one level at a time.
+    Matching on `root_inode` as well means only the partition holding the
+    root's scan gets searched.
+
+    `root_inodes` may also be a query returning (device, inode) columns. The
+    root each file was found under is in the `search_device` and
+    `search_inode` columns.
+
+    `mtime` may also be one of the rollup ages, e.g. 'P1Y' for files modified
+    less than a year before the scan or '-P1Y' for files modified before that
+
+    With `after`, a key from :func:`decode_cursor`, only files after that in
+    :func:`page_key` order are returned, and with `limit` only the first
+    `limit` files under each root in that order, so a page of results only
+    reads that much of each root's range
+    """
+    if isinstance(root_inodes, sa.sql.FromClause):
+        roots = root_inodes
+    else:
+        roots = roots_query(root_inodes)
+
+    root = m.Inode.__table__.alias("root")
+    inode = m.Inode.__table__
+    dir_path = m.DirPath.__table__.alias("dir_path")
+
+    subtree = roots.join(
+        root, sa.and_(root.c.inode == roots.c.inode, root.c.device == roots.c.device),
+    )
+
+    # Everything under each root, as a lateral subquery so that a limit
+    # applies to each root's range scan
+    matches = sa.select(inode.c).where(
+        sa.and_(
+            inode.c.device == root.c.device,
+            inode.c.root_inode == root.c.root_inode,
+            inode.c.seq.between(
+                root.c.seq, root.c.seq.concat(sa.literal(b"\xff", sa.LargeBinary)),
+            ),
+        )
+    )
+
+    if is_age(mtime):
+        # Ages are relative to when the root of the scan was scanned
+        scanned = m.Inode.__table__.alias("scanned")
+        subtree = subtree.join(
+            scanned,
+            sa.and_(
+                scanned.c.device == root.c.device,
+                scanned.c.root_inode == root.c.root_inode,
+                scanned.c.inode == root.c.root_inode,
+            ),
+        )
+        cutoff = age_cutoff(scanned.c.scan_time, mtime.lstrip("-"))
+        if mtime.startswith("-"):
+            matches = matches.where(inode.c.mtime < cutoff)
+        else:
+            matches = matches.where(
+                sa.and_(inode.c.mtime >= cutoff, inode.c.mtime < scanned.c.scan_time)
+            )
+        mtime = None
 
     if gid is not None:
-        q = q.where(child_paths.c.gid == gid)
+        matches = matches.where(inode.c.gid == gid)
     if not_gid is not None:
-        q = q.where(child_paths.c.gid != not_gid)
+        matches = matches.where(inode.c.gid != not_gid)
     if uid is not None:
-        q = q.where(child_paths.c.uid == uid)
+        matches = matches.where(inode.c.uid == uid)
     if not_uid is not None:
-        q = q.where(child_paths.c.uid != not_uid)
+        matches = matches.where(inode.c.uid != not_uid)
     if mtime is not None:
         if mtime < 0:
-            q = q.where(child_paths.c.mtime <= -mtime)
+            matches = matches.where(inode.c.mtime <= -mtime)
         else:
-            q = q.where(child_paths.c.mtime >= mtime)
+            matches = matches.where(inode.c.mtime >= mtime)
     if size is not None:
         if size < 0:
-            q = q.where(child_paths.c.size <= -size)
+            matches = matches.where(inode.c.size <= -size)
         else:
-            q = q.where(child_paths.c.size >= size)
+            matches = matches.where(inode.c.size >= size)
+
+    if after is not None:
+        matches = matches.where(sa.tuple_(*page_key(inode)) > after)
+    if limit is not None:
+        matches = matches.order_by(*page_key(inode)).limit(limit)
+
+    matches = matches.lateral("inode")
+
+    q = sa.select(
+        [
+            *matches.c,
+            m.inode_path(matches, dir_path).label("path"),
+            roots.c.device.label("search_device"),
+            roots.c.inode.label("search_inode"),
+        ]
+    ).select_from(m.join_dir_path(subtree.join(matches, sa.true()), matches, dir_path))
 
     return q
 
 
-def du_impl(*args, **kwargs):
+def rollup_filter(q, rollup, gid, not_gid, uid, not_uid, mtime):
+    """
+    Restrict `q` to the rows of the directory totals `rollup` matching the
+    find condition, `mtime` must be None or an age like 'P1Y'
+    """
+    if gid is not None:
+        q = q.where(rollup.c.gid == gid)
+    if not_gid is not None:
+        q = q.where(rollup.c.gid != not_gid)
+    if uid is not None:
+        q = q.where(rollup.c.uid == uid)
+    if not_uid is not None:
+        q = q.where(rollup.c.uid != not_uid)
+    if mtime is not None:
+        age = sa.cast(rollup.c.min_age, sa.Interval)
+        if mtime.startswith("-"):
+            q = q.where(age >= sa.cast(mtime[1:], sa.Interval))
+        else:
+            q = q.where(age < sa.cast(mtime, sa.Interval))
+    return q
+
+
+def rollup_du(roots, gid=None, not_gid=None, uid=None, not_uid=None, mtime=None):
+    """
+    Returns the total size in bytes and inodes under each of `roots` using the
+    precomputed directory totals, as (device, inode, size, inodes) rows
+
+    The totals are split by uid, gid and age, so the ownership filters and
+    ages like 'P1Y' (see :func:`recursive_search`) select whole rows.
+
+    Roots without totals, e.g. because the scan didn't write rollups, are
+    searched recursively instead
+    """
+    rollup = m.DirRollup.__table__.alias("rollup")
+
+    on_root = sa.and_(
+        rollup.c.device == roots.c.device, rollup.c.inode == roots.c.inode
+    )
+
+    rolled = sa.select(
+        [roots.c.device, roots.c.inode, rollup.c.size, rollup.c.inodes]
+    ).select_from(rollup.join(roots, on_root))
+
+    rolled = rollup_filter(rolled, rollup, gid, not_gid, uid, not_uid, mtime)
+
+    missing = sa.select(roots.c).where(~sa.exists().where(on_root)).alias("missing")
+    walked = walk_du(missing, gid, not_gid, uid, not_uid, mtime, None)
+
+    return sa.union_all(rolled, walked)
+
+
+def walk_du(roots, gid, not_gid, uid, not_uid, mtime, size):
+    """
+    Returns the size in bytes of each file matching the find condition under
+    `roots`, as (device, inode, size, inodes) rows with the root the file was
+    found under
+    """
+    q = recursive_search(roots, gid, not_gid, uid, not_uid, mtime, size).alias("find")
+    return sa.select(
+        [
+            q.c.search_device.label("device"),
+            q.c.search_inode.label("inode"),
+            q.c.size,
+            sa.literal(1).label("inodes"),
+        ]
+    )
+
+
+def du_batch_impl(root_inodes, gid, not_gid, uid, not_uid, mtime, size):
+    """
+    Returns the total size in bytes and inodes of paths matching the find
+    condition under each of `root_inodes` as (device, inode, size, inodes)
+    rows, all in a single query
+
+    `root_inodes` may also be a query returning (device, inode) columns
+
+    Filters that line up with how the directory totals are split are read
+    from the totals, others like a size or an arbitrary mtime walk the tree
+    """
+    if isinstance(root_inodes, sa.sql.FromClause):
+        roots = root_inodes
+    else:
+        roots = roots_query(root_inodes)
+    roots = sa.select([roots.c.device, roots.c.inode]).distinct().alias("batch")
+
+    if size is None and (mtime is None or is_age(mtime)):
+        q = rollup_du(roots, gid, not_gid, uid, not_uid, mtime)
+    else:
+        q = walk_du(roots, gid, not_gid, uid, not_uid, mtime, size)
+    q = q.alias("du")
+
+    # Roots with nothing matching still get a row
+    return (
+        sa.select(
+            [
+                roots.c.device,
+                roots.c.inode,
+                sa.func.coalesce(sa.func.sum(q.c.size), 0).label("size"),
+                sa.cast(
+                    sa.func.coalesce(sa.func.sum(q.c.inodes), 0), sa.BigInteger
+                ).label("inodes"),
+            ]
+        )
+        .select_from(
+            roots.outerjoin(
+                q, sa.and_(q.c.device == roots.c.device, q.c.inode == roots.c.inode)
+            )
+        )
+        .group_by(roots.c.device, roots.c.inode)
+    )
+
+
+def du_impl(root_inodes, gid, not_gid, uid, not_uid, mtime, size):
     """
     Returns the total size in bytes and inodes of paths matching the find condition
     """
-    q = recursive_search(*args, **kwargs).alias("find")
-    q = sa.select(
-        [sa.func.sum(q.c.size).label("size"), sa.func.count().label("inodes")]
+    q = du_batch_impl(root_inodes, gid, not_gid, uid, not_uid, mtime, size).alias(
+        "du_batch"
     )
-    return q
+    return sa.select(
+        [
+            sa.func.sum(q.c.size).label("size"),
+            sa.cast(sa.func.sum(q.c.inodes), sa.BigInteger).label("inodes"),
+        ]
+    )
+
+
+def is_dir(mode):
+    """
+    SQL test for S_ISDIR(mode)
+    """
+    return mode.op("&")(0o170000) == stat.S_IFDIR
+
+
+def top_impl(
+    root_inodes,
+    gid,
+    not_gid,
+    uid,
+    not_uid,
+    mtime,
+    size,
+    count=50,
+    by="size",
+    directories=False,
+):
+    """
+    Returns the `count` largest files matching the find condition under
+    `root_inodes` as (path, size, inodes) rows, largest first
+
+    With `directories` returns the directories under `root_inodes` with the
+    largest totals of matching files instead, ordered `by` 'size' or
+    'inodes'. The totals come from the precomputed directory totals, so only
+    filters they're split by can be used (see :func:`rollup_du`).
+
+    Only `count` rows are kept while searching, so this doesn't sort
+    everything under the roots.
+    """
+    if by not in ("size", "inodes"):
+        raise ValueError(f"Can't order by {by}")
+
+    if not directories:
+        if by != "size":
+            raise ValueError("Files can only be ordered by size")
+
+        q = recursive_search(
+            root_inodes, gid, not_gid, uid, not_uid, mtime, size
+        ).alias("find")
+        return (
+            sa.select([q.c.path, q.c.size, sa.literal(1).label("inodes")])
+            .where(~is_dir(q.c.mode))
+            .order_by(q.c.size.desc())
+            .limit(count)
+        )
+
+    if size is not None or not (mtime is None or is_age(mtime)):
+        raise ValueError("Directory totals can only be filtered by user, group and age")
+
+    dirs = recursive_search(root_inodes, None, None, None, None, None, None).alias(
+        "find"
+    )
+    rollup = m.DirRollup.__table__.alias("rollup")
+
+    q = (
+        sa.select(
+            [
+                dirs.c.path,
+                sa.func.sum(rollup.c.size).label("size"),
+                sa.cast(sa.func.sum(rollup.c.inodes), sa.BigInteger).label("inodes"),
+            ]
+        )
+        .select_from(
+            dirs.join(
+                rollup,
+                sa.and_(
+                    rollup.c.device == dirs.c.device, rollup.c.inode == dirs.c.inode
+                ),
+            )
+        )
+        .where(is_dir(dirs.c.mode))
+        .group_by(dirs.c.device, dirs.c.inode, dirs.c.path)
+    )
+
+    q = rollup_filter(q, rollup, gid, not_gid, uid, not_uid, mtime)
+
+    return q.order_by(sa.desc(by)).limit(count)
+
+
+def inode_impl(root_inode):
+    """
+    Returns the path and parent of the inode `root_inode`
+    """
+    inode = m.Inode.__table__.alias("inode")
+    dir_path = m.DirPath.__table__.alias("dir_path")
+
+    return (
+        sa.select(
+            [
+                inode.c.device,
+                inode.c.inode,
+                inode.c.parent_inode,
+                m.inode_path(inode, dir_path).label("path"),
+            ]
+        )
+        .select_from(m.join_dir_path(inode, inode, dir_path))
+        .where(inode.c.device == root_inode[0])
+        .where(inode.c.inode == root_inode[1])
+    )
+
+
+def children_impl(root_inode, gid, not_gid, uid, not_uid, mtime, size):
+    """
+    Returns every child of the directory `root_inode` with the total size in
+    bytes and inodes matching the find condition under it, as (device, inode,
+    basename, mode, size, inodes) rows
+
+    The children come from the index on their parent in the partition of the
+    directory's scan, and their totals as from :func:`du_batch_impl`
+    """
+    parent = m.Inode.__table__.alias("parent")
+    child = m.Inode.__table__.alias("child")
+
+    children = (
+        sa.select([child.c.device, child.c.inode, child.c.basename, child.c.mode])
+        .select_from(
+            parent.join(
+                child,
+                sa.and_(
+                    child.c.device == parent.c.device,
+                    child.c.root_inode == parent.c.root_inode,
+                    child.c.parent_inode == parent.c.inode,
+                ),
+            )
+        )
+        .where(parent.c.device == root_inode[0])
+        .where(parent.c.inode == root_inode[1])
+        .alias("children")
+    )
+
+    totals = du_batch_impl(children, gid, not_gid, uid, not_uid, mtime, size).alias(
+        "totals"
+    )
+
+    return sa.select([*children.c, totals.c.size, totals.c.inodes]).select_from(
+        children.join(
+            totals,
+            sa.and_(
+                totals.c.device == children.c.device,
+                totals.c.inode == children.c.inode,
+            ),
+        )
+    )
+
+
+def inode_type(mode):
+    """
+    The type of an inode from its mode, as the letter used by 'find -type'
+    """
+    for letter, test in [
+        ("d", stat.S_ISDIR),
+        ("f", stat.S_ISREG),
+        ("l", stat.S_ISLNK),
+        ("p", stat.S_ISFIFO),
+        ("s", stat.S_ISSOCK),
+        ("c", stat.S_ISCHR),
+        ("b", stat.S_ISBLK),
+    ]:
+        if test(mode):
+            return letter
+    return None
+
+
+def page_key(inode):
+    """
+    Columns of `inode` that pages of results are ordered by
+
+    `seq` alone isn't unique, every scanned root starts from the same `seq`
+    and hard links in the same directory share theirs
+    """
+    return [inode.c.device, inode.c.seq, inode.c.root_inode, inode.c.basename]
+
+
+def encode_cursor(device, seq, root_inode, basename):
+    """
+    Opaque cursor for continuing a search after the file with the given
+    :func:`page_key`
+    """
+    raw = (
+        device.to_bytes(8, "big", signed=True)
+        + root_inode.to_bytes(8, "big", signed=True)
+        + len(seq).to_bytes(2, "big")
+        + bytes(seq)
+        + basename.encode("utf-8")
+    )
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
 
+def decode_cursor(cursor):
+    """
+    The :func:`page_key` values of a cursor from :func:`encode_cursor`
+
+    Raises ValueError if it isn't a valid cursor
+    """
+    raw = base64.urlsafe_b64decode(cursor.encode("ascii"))
+    if len(raw) < 18:
+        raise ValueError("Cursor is too short")
+
+    device = int.from_bytes(raw[:8], "big", signed=True)
+    root_inode = int.from_bytes(raw[8:16], "big", signed=True)
+    end = 18 + int.from_bytes(raw[16:18], "big")
+    if len(raw) < end:
+        raise ValueError("Cursor is too short")
+
+    return (device, raw[18:end], root_inode, raw[end:].decode("utf-8"))
 
-def find_impl(*args, **kwargs):
+
+def find_impl(*args, limit=None, after=None, **kwargs):
     """
     Returns all paths matching the find conditions
+
+    With `limit` only that many paths are returned, pass the cursor of the
+    last one from :func:`encode_cursor` as `after` to get the next page.
+    Pages are in :func:`page_key` order, list each file once even if it's
+    under more than one root, and only read as much of the index as they
+    return.
     """
-    q = recursive_search(*args, **kwargs).alias("find")
-    q = sa.select([q.c.path])
+    if after is not None:
+        after = decode_cursor(after)
+
+    q = recursive_search(*args, after=after, limit=limit, **kwargs).alias("find")
+    q = sa.select([q.c.path, *page_key(q)])
+
+    if limit is not None or after is not None:
+        # Files under more than one of the roots are only listed once
+        q = q.distinct().order_by(*page_key(q)).limit(limit)
     return q
 
 
@@ -189,7 +610,9 @@ def find_parse(root_paths, group=None, user=None, mtime=None, size=None):
         else:
             response["uid"] = pwd.getpwnam(user).pw_uid
     if mtime is not None:
-        if mtime.startswith("-"):
+        if mtime.lstrip("-") in ages:
+            response["mtime"] = mtime
+        elif mtime.startswith("-"):
             response["mtime"] = -time_delta_arg(mtime[1:])
         else:
             response["mtime"] = time_delta_arg(mtime)
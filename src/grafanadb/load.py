@@ -0,0 +1,685 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from grafanadb.dusql_scan import columns, rollup_columns, scan_format
+
+import psycopg2
+import psycopg2.errors
+import argparse
+import concurrent.futures
+import functools
+import os
+import threading
+import time
+
+# Tables making up a snapshot of the filesystem, with (name, unique, columns)
+# of the indexes built on each once it's loaded
+tables = {
+    "dusql_inode": (
+        """
+        basename TEXT NOT NULL,
+        inode BIGINT,
+        device BIGINT,
+        mode INTEGER,
+        uid INTEGER,
+        gid INTEGER,
+        size BIGINT,
+        mtime FLOAT,
+        atime FLOAT,
+        scan_time FLOAT,
+        root_inode BIGINT,
+        parent_inode BIGINT,
+        seq BYTEA
+        """,
+        [
+            ("dusql_inode_id", False, "device, inode"),
+            ("dusql_inode_parent", False, "device, parent_inode"),
+            ("dusql_inode_seq", False, "device, seq"),
+        ],
+    ),
+    "dusql_dir_rollup": (
+        """
+        device BIGINT,
+        inode BIGINT,
+        root_inode BIGINT,
+        uid INTEGER,
+        gid INTEGER,
+        min_age TEXT,
+        last_access TEXT,
+        inodes BIGINT,
+        size BIGINT,
+        mtime FLOAT
+        """,
+        [("dusql_dir_rollup_id", False, "device, inode")],
+    ),
+    "dusql_dir_path": (
+        """
+        device BIGINT,
+        inode BIGINT,
+        path TEXT
+        """,
+        [("dusql_dir_path_id", True, "device, inode")],
+    ),
+    "dusql_root": (
+        """
+        device BIGINT,
+        inode BIGINT,
+        path TEXT
+        """,
+        [("dusql_root_id", True, "device, inode")],
+    ),
+}
+
+# Records each snapshot once it's published
+generation_sql = """
+CREATE TABLE IF NOT EXISTS dusql_generation (
+        id SERIAL PRIMARY KEY,
+        time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+        schema TEXT -- schema holding the tables of this snapshot
+)
+"""
+
+# Each process of a scan writes rollups for its own part of the tree, which
+# need adding together
+rollup_sql = """
+INSERT INTO dusql_dir_rollup
+SELECT device, inode, root_inode, uid, gid, min_age, last_access,
+        sum(inodes), sum(size), max(mtime)
+FROM dusql_dir_rollup_load
+GROUP BY device, inode, root_inode, uid, gid, min_age, last_access
+"""
+
+# The rollups of the scanned roots are split by the same ages as the
+# historical summaries, so these come from them rather than another pass over
+# dusql_inode
+history_sql = """
+INSERT INTO dusql_history(root_inode, uid, gid, inodes, size, min_age, time)
+SELECT root_inode, uid, gid, sum(inodes), sum(size), min_age::INTERVAL, CURRENT_TIMESTAMP
+FROM {schema}.dusql_dir_rollup
+WHERE inode = root_inode
+AND min_age IS NOT NULL
+GROUP BY root_inode, uid, gid, min_age;
+
+INSERT INTO dusql_access(root_inode, uid, gid, inodes, size, last_access, time)
+SELECT root_inode, uid, gid, sum(inodes), sum(size), last_access::INTERVAL, CURRENT_TIMESTAMP
+FROM {schema}.dusql_dir_rollup
+WHERE inode = root_inode
+AND last_access IS NOT NULL
+GROUP BY root_inode, uid, gid, last_access;
+"""
+
+# Store the full path of every directory, so the path of an inode is just its
+# parent directory's path and its basename rather than a walk up the tree
+# with dusql_path_func
+path_sql = """
+CREATE TEMPORARY TABLE dusql_dir_tmp ON COMMIT DROP AS
+        SELECT device, inode, root_inode, parent_inode, basename
+        FROM dusql_inode
+        WHERE mode & 61440 = 16384; -- S_ISDIR(mode)
+CREATE INDEX ON dusql_dir_tmp(device, root_inode, parent_inode);
+ANALYZE dusql_dir_tmp;
+
+-- Each walk stays within its own root's scan, as a directory under a nested
+-- root is in dusql_inode once for each root
+WITH RECURSIVE x AS (
+        SELECT device, inode, root_inode, basename AS path
+        FROM dusql_dir_tmp
+        WHERE parent_inode IS NULL
+        UNION ALL
+        SELECT d.device, d.inode, d.root_inode, x.path || '/' || d.basename AS path
+        FROM x
+        JOIN dusql_dir_tmp AS d
+        ON d.parent_inode = x.inode
+        AND d.device = x.device
+        AND d.root_inode = x.root_inode
+)
+-- A directory under more than one scanned root only gets one path
+INSERT INTO dusql_dir_path(device, inode, path)
+        SELECT DISTINCT ON (device, inode) device, inode, path FROM x;
+
+-- The scanned roots, so they can be listed without a pass over dusql_inode
+INSERT INTO dusql_root(device, inode, path)
+        SELECT DISTINCT ON (device, inode) device, inode, basename
+        FROM dusql_dir_tmp
+        WHERE parent_inode IS NULL;
+"""
+
+# Apply a delta from 'dusql_scan.py --delta'. A changed row is in both
+# dusql_delete and dusql_insert, so all the deletes need doing first.
+merge_sql = """
+DELETE FROM dusql_inode AS i
+USING dusql_delete AS d
+WHERE i.device = d.device
+AND i.inode IS NOT DISTINCT FROM d.inode -- NULL for unreadable entries
+AND i.root_inode = d.root_inode
+AND i.parent_inode IS NOT DISTINCT FROM d.parent_inode
+AND i.basename = d.basename;
+
+INSERT INTO dusql_inode SELECT * FROM dusql_insert;
+"""
+
+# Update the paths of directories that are new or have been moved or
+# renamed, and everything under them. Paths are worked out from the
+# parent's current path, which is out of date if an ancestor has moved as
+# well, but then the path found by walking down from the ancestor is deeper
+# and replaces it.
+merge_path_sql = """
+DELETE FROM dusql_dir_path AS p
+USING dusql_delete AS d
+WHERE p.device = d.device
+AND p.inode = d.inode
+AND NOT EXISTS (
+        SELECT 1 FROM dusql_inode AS i
+        WHERE i.device = d.device
+        AND i.inode = d.inode
+        AND i.mode & 61440 = 16384
+);
+
+WITH RECURSIVE x AS (
+        SELECT n.device, n.inode, n.root_inode,
+                CASE WHEN n.parent_inode IS NULL THEN n.basename
+                ELSE p.path || '/' || n.basename END AS path,
+                0 AS depth
+        FROM dusql_insert AS n
+        LEFT JOIN dusql_dir_path AS p
+        ON p.device = n.device
+        AND p.inode = n.parent_inode
+        WHERE n.mode & 61440 = 16384
+        AND NOT EXISTS (
+                SELECT 1 FROM dusql_delete AS o
+                WHERE o.device = n.device
+                AND o.inode = n.inode
+                AND o.parent_inode IS NOT DISTINCT FROM n.parent_inode
+                AND o.basename = n.basename
+        )
+        UNION ALL
+        SELECT d.device, d.inode, d.root_inode,
+                x.path || '/' || d.basename AS path, x.depth + 1
+        FROM x
+        JOIN dusql_inode AS d
+        ON d.parent_inode = x.inode
+        AND d.device = x.device
+        AND d.root_inode = x.root_inode
+        WHERE d.mode & 61440 = 16384
+)
+INSERT INTO dusql_dir_path(device, inode, path)
+        SELECT DISTINCT ON (device, inode) device, inode, path
+        FROM x
+        ORDER BY device, inode, depth DESC
+ON CONFLICT (device, inode) DO UPDATE SET path = EXCLUDED.path;
+"""
+
+# Roots that have been removed or added by a delta
+merge_root_sql = """
+DELETE FROM dusql_root AS r
+USING dusql_delete AS d
+WHERE r.device = d.device
+AND r.inode = d.inode
+AND d.parent_inode IS NULL;
+
+INSERT INTO dusql_root(device, inode, path)
+        SELECT device, inode, basename
+        FROM dusql_insert
+        WHERE parent_inode IS NULL
+        AND mode & 61440 = 16384
+ON CONFLICT (device, inode) DO NOTHING;
+"""
+
+# Only one load can run at a time
+lock_id = 0x6475_7371
+
+# dusql_inode is split into partitions by the scanned root, so each
+# partition's indexes can be built at the same time, and a search under a
+# directory only needs to look in its root's partition
+partition_key = "device, root_inode"
+
+
+def schema_name(generation):
+    return f"dusql_g{generation}"
+
+
+def partition_name(table, index):
+    return f"{table}_p{index}"
+
+
+def connect(url, schema):
+    """
+    Connect to the database at `url`, looking for tables in `schema` first
+    """
+    conn = psycopg2.connect(url)
+    with conn.cursor() as cur:
+        cur.execute(f"SET search_path TO {schema}, public")
+    conn.commit()
+    return conn
+
+
+def parallel(url, schema, jobs, tasks):
+    """
+    Run `tasks`, functions taking a cursor, using `jobs` connections at once
+
+    Each task is committed once it finishes
+    """
+    local = threading.local()
+    conns = []
+
+    def run(task):
+        if not hasattr(local, "conn"):
+            local.conn = connect(url, schema)
+            conns.append(local.conn)
+
+        with local.conn.cursor() as cur:
+            task(cur)
+        local.conn.commit()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            # Raises the first error from any task
+            list(pool.map(run, tasks))
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def execute(sql, cur):
+    cur.execute(sql)
+
+
+# Table to load each kind of scan output file into, by the start of its name
+shard_tables = {
+    "dusql": ("dusql_inode", columns),
+    "dusql_rollup": ("dusql_dir_rollup_load", rollup_columns),
+    "dusql_insert": ("dusql_insert", columns),
+    "dusql_delete": ("dusql_delete", columns),
+}
+
+
+def shard_kind(path):
+    return os.path.basename(path).split(".")[0]
+
+
+def check_kinds(paths, kinds):
+    """
+    Make sure all of the files in `paths` are of the expected `kinds`
+    """
+    for path in paths:
+        if shard_kind(path) not in kinds:
+            raise ValueError(f"Can't load {path} here, expected {' or '.join(kinds)}")
+
+
+def copy_shard(path, cur):
+    """
+    COPY a scan output file into the table being loaded
+
+    Rollup files, named 'dusql_rollup.*', go to 'dusql_dir_rollup_load' to be
+    summed up, and the 'dusql_insert.*' and 'dusql_delete.*' files of a delta
+    to tables of those names
+    """
+    table, cols = shard_tables[shard_kind(path)]
+
+    opener, output_format = scan_format(path)
+    with opener(path, "rb") as f:
+        cur.copy_expert(
+            f"COPY {table}({', '.join(cols)}) FROM STDIN WITH (FORMAT {output_format.upper()})",
+            f,
+        )
+
+
+def summarise(cur):
+    """
+    Fill in dusql_dir_rollup, dusql_dir_path and dusql_root from the loaded
+    data
+    """
+    cur.execute(rollup_sql)
+    cur.execute("DROP TABLE dusql_dir_rollup_load")
+    cur.execute(path_sql)
+
+    for name in ["dusql_dir_rollup", "dusql_dir_path", "dusql_root"]:
+        definition, indexes = tables[name]
+        for index, unique, on in indexes:
+            cur.execute(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX {index} ON {name}({on})"
+            )
+        cur.execute(f"ANALYZE {name}")
+
+
+def build(conn, url, paths, copied=False, jobs=4, partitions=16):
+    """
+    Load the scan output files `paths` into a new schema, which isn't visible
+    to any queries until it is published
+
+    Up to `jobs` files are copied at once, each on its own connection, into
+    `partitions` partitions of dusql_inode, then the indexes of each partition
+    are built in parallel.
+
+    With `copied` the tables written by ``dusql_scan.py --copy-to`` are loaded
+    instead
+
+    Returns the generation number of the new schema
+    """
+    check_kinds(paths, ["dusql", "dusql_rollup"])
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT nextval(pg_get_serial_sequence('dusql_generation', 'id'))")
+        (generation,) = cur.fetchone()
+        schema = schema_name(generation)
+
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}, public")
+
+        definition, indexes = tables["dusql_inode"]
+        cur.execute(
+            f"CREATE TABLE dusql_inode ({definition}) PARTITION BY HASH ({partition_key})"
+        )
+        for i in range(partitions):
+            cur.execute(
+                f"CREATE UNLOGGED TABLE {partition_name('dusql_inode', i)} PARTITION OF dusql_inode FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i})"
+            )
+        for index, unique, on in indexes:
+            # Not valid until the index on each partition is attached
+            cur.execute(f"CREATE INDEX {index} ON ONLY dusql_inode({on})")
+
+        for name in ["dusql_dir_rollup", "dusql_dir_path", "dusql_root"]:
+            cur.execute(f"CREATE UNLOGGED TABLE {name} ({tables[name][0]})")
+
+        if copied:
+            cur.execute(f"ALTER TABLE public.dusql_dir_rollup_load SET SCHEMA {schema}")
+            cur.execute(
+                f"INSERT INTO dusql_inode({', '.join(columns)}) SELECT {', '.join(columns)} FROM public.dusql_inode_load"
+            )
+            cur.execute("DROP TABLE public.dusql_inode_load")
+        else:
+            cur.execute(
+                "CREATE UNLOGGED TABLE dusql_dir_rollup_load (LIKE dusql_dir_rollup)"
+            )
+    conn.commit()
+
+    # Start with the biggest files so one big file isn't left to last
+    paths = sorted(paths, key=os.path.getsize, reverse=True)
+    parallel(url, schema, jobs, [functools.partial(copy_shard, p) for p in paths])
+
+    tasks = [summarise]
+    for i in range(partitions):
+        partition = partition_name("dusql_inode", i)
+        for index, unique, on in indexes:
+            tasks.append(
+                functools.partial(
+                    execute,
+                    f"CREATE INDEX {partition_name(index, i)} ON {partition}({on})",
+                )
+            )
+    parallel(url, schema, jobs, tasks)
+
+    with conn.cursor() as cur:
+        for i in range(partitions):
+            for index, unique, on in indexes:
+                cur.execute(
+                    f"ALTER INDEX {index} ATTACH PARTITION {partition_name(index, i)}"
+                )
+        cur.execute("ANALYZE dusql_inode")
+    conn.commit()
+
+    return generation
+
+
+def record_history(cur, schema):
+    """
+    Add the totals from the rollups in `schema` to dusql_history and
+    dusql_access, if they exist
+    """
+    cur.execute(
+        "SELECT to_regclass('public.dusql_history') IS NOT NULL AND to_regclass('public.dusql_access') IS NOT NULL"
+    )
+    if cur.fetchone()[0]:
+        cur.execute(history_sql.format(schema=schema))
+
+
+def replace_view(cur, name, query):
+    """
+    Create or replace the view `name`
+
+    If the columns have changed the view has to be dropped first, which fails
+    if anything else depends on it
+    """
+    cur.execute("SAVEPOINT replace_view")
+    try:
+        cur.execute(f"CREATE OR REPLACE VIEW {name} AS {query}")
+    except psycopg2.errors.InvalidTableDefinition:
+        cur.execute("ROLLBACK TO SAVEPOINT replace_view")
+        cur.execute(f"DROP VIEW {name}")
+        cur.execute(f"CREATE VIEW {name} AS {query}")
+    cur.execute("RELEASE SAVEPOINT replace_view")
+
+
+def publish(conn, generation, lock_timeout=5, retries=60):
+    """
+    Point the views in the public schema at the tables of `generation`, and
+    record its totals in dusql_history and dusql_access
+
+    Queries already running carry on with the old tables. Replacing a view
+    has to wait for queries using it to finish, and new queries queue up
+    behind it while it waits, so rather than wait for a long query this gives
+    up after `lock_timeout` seconds and tries again later.
+    """
+    schema = schema_name(generation)
+
+    for attempt in range(retries):
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SET LOCAL lock_timeout = '{lock_timeout}s'")
+
+                for name in tables:
+                    cur.execute(
+                        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+                        (f"public.{name}",),
+                    )
+                    kind = cur.fetchone()
+                    if kind is not None and kind[0] != "v":
+                        # A table from before loads used views
+                        cur.execute(f"DROP TABLE public.{name} CASCADE")
+
+                    replace_view(
+                        cur, f"public.{name}", f"SELECT * FROM {schema}.{name}"
+                    )
+                    cur.execute(f"GRANT SELECT ON public.{name} TO dusql")
+
+                record_history(cur, schema)
+
+                cur.execute(
+                    "INSERT INTO dusql_generation(id, schema) VALUES (%s, %s)",
+                    (generation, schema),
+                )
+                # The server checks this to see when its cache is out of date
+                cur.execute("GRANT SELECT ON dusql_generation TO dusql")
+            conn.commit()
+            return
+
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            time.sleep(lock_timeout)
+
+    raise Exception(f"Unable to publish {schema}, the views are always in use")
+
+
+def drop_old(conn, generation):
+    """
+    Remove the schemas of generations before `generation`
+
+    This waits for any queries still using them to finish
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT nspname FROM pg_namespace WHERE nspname LIKE 'dusql\\_g%%'")
+        schemas = [s for (s,) in cur.fetchall() if s != schema_name(generation)]
+
+    for schema in schemas:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.commit()
+
+
+def merge_delta(conn, paths):
+    """
+    Apply the deltas from 'dusql_scan.py --delta' in `paths` to the current
+    snapshot
+
+    This changes the live tables in place, in one transaction, so queries
+    keep seeing the old snapshot until it's done. If there are rollup files
+    in `paths` they replace the current rollups, and their totals are
+    recorded in dusql_history and dusql_access.
+
+    Returns the generation number of the updated snapshot
+    """
+    check_kinds(paths, ["dusql_insert", "dusql_delete", "dusql_rollup"])
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT schema FROM dusql_generation ORDER BY id DESC LIMIT 1")
+        current = cur.fetchone()
+        if current is None or current[0] is None:
+            raise Exception("No snapshot to merge into, do a full load first")
+        (schema,) = current
+
+        cur.execute(f"SET LOCAL search_path TO {schema}, public")
+
+        for table in ["dusql_insert", "dusql_delete"]:
+            cur.execute(
+                f"CREATE TEMPORARY TABLE {table} (LIKE dusql_inode) ON COMMIT DROP"
+            )
+        cur.execute(
+            "CREATE TEMPORARY TABLE dusql_dir_rollup_load (LIKE dusql_dir_rollup) ON COMMIT DROP"
+        )
+
+        for path in paths:
+            copy_shard(path, cur)
+
+        for table in ["dusql_insert", "dusql_delete", "dusql_dir_rollup_load"]:
+            cur.execute(f"ANALYZE {table}")
+
+        cur.execute(merge_sql)
+        cur.execute(merge_path_sql)
+
+        # Snapshots loaded before dusql_root was added don't have it
+        cur.execute("SELECT to_regclass('dusql_root') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute(merge_root_sql)
+
+        cur.execute("SELECT EXISTS (SELECT 1 FROM dusql_dir_rollup_load)")
+        if cur.fetchone()[0]:
+            cur.execute("DELETE FROM dusql_dir_rollup")
+            cur.execute(rollup_sql)
+            record_history(cur, schema)
+
+        cur.execute(
+            "INSERT INTO dusql_generation(schema) VALUES (%s) RETURNING id", (schema,)
+        )
+        (generation,) = cur.fetchone()
+
+    conn.commit()
+    return generation
+
+
+def load(url, paths, copied=False, lock_timeout=5, jobs=4, partitions=16, merge=False):
+    """
+    Load the scan output files `paths` into the database at `url`
+
+    The new snapshot is built in its own schema, then swapped in by pointing
+    the views 'dusql_inode', 'dusql_dir_rollup', 'dusql_dir_path' and
+    'dusql_root' at it,
+    so the server can keep querying the old snapshot at full speed until the
+    new one is complete. With `merge` `paths` are deltas to apply to the
+    current snapshot instead, see :func:`merge_delta`. Returns the generation number
+    of the new snapshot.
+    """
+    conn = psycopg2.connect(url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(generation_sql)
+            cur.execute("SELECT pg_advisory_lock(%s)", (lock_id,))
+        conn.commit()
+
+        if merge:
+            return merge_delta(conn, paths)
+
+        generation = build(conn, url, paths, copied, jobs, partitions)
+        publish(conn, generation, lock_timeout)
+        drop_old(conn, generation)
+
+        return generation
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load dusql_scan.py output into the database"
+    )
+    parser.add_argument("url", help="Database to load into")
+    parser.add_argument(
+        "path",
+        nargs="*",
+        help="Scan output files, 'dusql_rollup.*' files are loaded as rollups",
+    )
+    parser.add_argument(
+        "--copied",
+        action="store_true",
+        help="Load the tables 'dusql_inode_load' and 'dusql_dir_rollup_load' written by 'dusql_scan.py --copy-to' instead of files",
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Apply the 'dusql_insert.*' and 'dusql_delete.*' files from 'dusql_scan.py --delta' to the current tables, along with any rollup files",
+    )
+    parser.add_argument(
+        "--lock-timeout",
+        type=float,
+        default=5,
+        metavar="SECONDS",
+        help="How long to wait for running queries when swapping in the new tables (default %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        help="Number of connections to load with at once (default %(default)s)",
+    )
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=16,
+        help="Number of partitions to split dusql_inode into (default %(default)s)",
+    )
+    args = parser.parse_intermixed_args()
+
+    if args.copied and len(args.path) > 0:
+        parser.error("--copied doesn't take any paths")
+    if args.copied and args.merge:
+        parser.error("--copied can't be used with --merge")
+
+    generation = load(
+        args.url,
+        args.path,
+        copied=args.copied,
+        lock_timeout=args.lock_timeout,
+        jobs=args.jobs,
+        partitions=args.partitions,
+        merge=args.merge,
+    )
+    print(f"Loaded generation {generation}")
+
+
+if __name__ == "__main__":
+    main()
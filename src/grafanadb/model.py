@@ -23,6 +23,37 @@ import sqlalchemy.orm as orm
 metadata = sa.MetaData()
 Base = declarative_base()
 
+# The full path of a directory
+class DirPath(Base):
+    __tablename__ = "dusql_dir_path"
+
+    device = sa.Column("device", sa.BigInteger, primary_key=True)
+    inode = sa.Column("inode", sa.BigInteger, primary_key=True)
+    path = sa.Column("path", sa.Text)
+
+
+def inode_path(inode, dir_path):
+    """
+    The full path of rows from `inode`, where `dir_path` is
+    :class:`DirPath` joined on their parent directory
+    """
+    # Roots have no parent, their basename is their full path
+    return sa.func.coalesce(dir_path.c.path + "/" + inode.c.basename, inode.c.basename)
+
+
+def join_dir_path(from_, inode, dir_path):
+    """
+    Left join `dir_path` to `from_` on the parent directory of `inode`
+    """
+    return from_.outerjoin(
+        dir_path,
+        sa.and_(
+            dir_path.c.inode == inode.c.parent_inode,
+            dir_path.c.device == inode.c.device,
+        ),
+    )
+
+
 # An inode on the file system
 class Inode(Base):
     __tablename__ = "dusql_inode"
@@ -45,6 +76,8 @@ class Inode(Base):
         sa.ForeignKey("dusql_inode.inode"),
         primary_key=True,
     )
+    # Depth-first pre-order key, see grafanadb.dusql_scan.seq_key
+    seq = sa.Column("seq", sa.LargeBinary)
 
     root = orm.relationship(
         "Inode",
@@ -62,5 +95,39 @@ class Inode(Base):
     )
 
     path = orm.column_property(
-        sa.func.dusql_path_func(parent_inode, device, basename), deferred=True
+        sa.func.coalesce(
+            sa.select([DirPath.path + "/" + basename])
+            .where(DirPath.inode == parent_inode)
+            .where(DirPath.device == device)
+            .limit(1)
+            .as_scalar(),
+            basename,
+        ),
+        deferred=True,
     )
+
+
+# The roots scanned by dusql_scan.py
+class Root(Base):
+    __tablename__ = "dusql_root"
+
+    device = sa.Column("device", sa.BigInteger, primary_key=True)
+    inode = sa.Column("inode", sa.BigInteger, primary_key=True)
+    path = sa.Column("path", sa.Text)
+
+
+# Totals of everything under a directory owned by one uid and gid, split by
+# when it was last modified and accessed
+class DirRollup(Base):
+    __tablename__ = "dusql_dir_rollup"
+
+    device = sa.Column("device", sa.BigInteger, primary_key=True)
+    inode = sa.Column("inode", sa.BigInteger, primary_key=True)
+    root_inode = sa.Column("root_inode", sa.BigInteger)
+    uid = sa.Column("uid", sa.Integer, primary_key=True)
+    gid = sa.Column("gid", sa.Integer, primary_key=True)
+    min_age = sa.Column("min_age", sa.Text)
+    last_access = sa.Column("last_access", sa.Text)
+    inodes = sa.Column("inodes", sa.BigInteger)
+    size = sa.Column("size", sa.BigInteger)
+    mtime = sa.Column("mtime", sa.Float)
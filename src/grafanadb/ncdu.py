@@ -16,10 +16,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from grafanadb.find import find_parse
 from grafanadb.cli import pretty_size
 import curses
-import os
 import requests
 import functools
 
@@ -27,9 +25,13 @@ sort_size = lambda x: (x[1] if x[1] is not None else float("inf"))
 sort_inode = lambda x: (x[2] if x[2] is not None else float("inf"))
 
 @functools.lru_cache(maxsize=1024)
-def cached_du(root, gid, not_gid, uid, not_uid, mtime, size, api_key):
+def cached_children(root, gid, not_gid, uid, not_uid, mtime, size, api_key):
+    """
+    Path, parent and children with their usage of the directory `root`, from
+    a single request to the web service
+    """
     try:
-        args = {'root_inodes': [root],
+        args = {'root_inode': root,
             "gid": gid,
             "not_gid": not_gid,
             "uid": uid,
@@ -39,9 +41,9 @@ def cached_du(root, gid, not_gid, uid, not_uid, mtime, size, api_key):
             "api_key": api_key,
             }
         r = requests.get(
-            "https://accessdev.nci.org.au/dusql/du",
+            "https://accessdev.nci.org.au/dusql/children",
             json=args,
-            timeout=8,
+            timeout=60,
         )
         r.raise_for_status()
         r = r.json()
@@ -56,6 +58,10 @@ class State:
 
         self.path = root_path
 
+        # The (device, inode) of the current path and its parent
+        self.root = tuple(find_args['root_inodes'][0])
+        self.parent = None
+
         # The children of the current path
         self.children = []
 
@@ -75,44 +81,42 @@ class State:
         self.row = 0
 
         # Initialise the directory list
-        self.chdir(".")
+        self.chdir(self.root)
 
-    def chdir(self, path):
+    def chdir(self, root):
         """
-        Change the current directory to `path` (relative to the current path)
+        Change the current directory to the (device, inode) `root`
+
+        Everything comes from the database, so directories can be browsed
+        without reading them
         """
-        self.path = os.path.normpath(os.path.join(self.path, path))
-        rows, cols = self.window.getmaxyx()
+        if root is None:
+            return
+        try:
+            r = cached_children(tuple(root), **self.find_args)
+        except:
+            return
+
+        self.root = tuple(root)
+        self.path = r["path"]
+        self.parent = r["parent"]
 
         # Reset the pad
         self.pad.clear()
         self.row = 0
         self.pad_offset = 0
 
-        # Build up the new list of children by doing a 'dusql du' on each of its immediate children
         self.children = []
-        with os.scandir(self.path) as it:
-            for entry in it:
-                root = (
-                        entry.stat(follow_symlinks=False).st_dev,
-                        entry.stat(follow_symlinks=False).st_ino,
-                    )
-                try:
-                    r = cached_du(root, **self.find_args)
-                except:
-                    r = {'size': None, 'inodes': None}
-                self.children.append(
-                    [
-                        entry.name,
-                        r["size"],
-                        r["inodes"],
-                        entry.is_dir(follow_symlinks=False),
-                    ]
-                )
-                # Update the screen so it's not too boring
-                if len(self.children) > rows:
-                    self.pad_offset = len(self.children) - rows
-                self.redraw()
+        for child in r["children"]:
+            self.children.append(
+                [
+                    child["basename"],
+                    child["size"],
+                    child["inodes"],
+                    child["type"] == "d",
+                    child["root"],
+                ]
+            )
 
         # Sort the retrieved files
         self.pad_offset = 0
@@ -151,7 +155,7 @@ class State:
 
         # Then the pad holds the list of files and their properties
         self.pad.addstr(0, 4, "..")
-        for i, (name, size, inodes, isdir) in enumerate(self.children):
+        for i, (name, size, inodes, isdir, root) in enumerate(self.children):
             attrs = curses.A_NORMAL
             if isdir:
                 attrs = curses.A_BOLD
@@ -198,11 +202,11 @@ class State:
             self.scroll(1)
         elif command in (curses.KEY_ENTER, curses.KEY_RIGHT, 10, 13):
             if self.row == 0:
-                self.chdir("..")
-            if self.children[self.row - 1][3]:
-                self.chdir(self.children[self.row - 1][0])
+                self.chdir(self.parent)
+            elif self.children[self.row - 1][3]:
+                self.chdir(self.children[self.row - 1][4])
         elif command == curses.KEY_LEFT:
-            self.chdir("..")
+            self.chdir(self.parent)
         elif command == ord("s"):
             self.sorter = sort_size
             self.resort()
@@ -16,16 +16,74 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort
 from jsonschema import validate
-from grafanadb.find import find_impl, du_impl
-from grafanadb.db import connect
+from grafanadb.find import (
+    find_impl,
+    du_impl,
+    du_batch_impl,
+    children_impl,
+    top_impl,
+    inode_impl,
+    inode_type,
+    encode_cursor,
+    ages,
+)
+from grafanadb.db import configure, read_router
+from grafanadb.cache import open_cache, current_generation, query_key
+import sqlalchemy as sa
+import psycopg2.errors
 import os
-import functools
+from json import dumps
 
 app = Flask(__name__)
 app.config["DATABASE"] = "postgresql://@/grafana"
 app.config["API_KEY"] = os.environ.get("API_KEY")
+app.config["QUERY_LOG"] = os.environ.get("DUSQL_QUERY_LOG")
+app.config["REPLICAS"] = os.environ.get("DUSQL_REPLICAS", "").split()
+
+# Each worker process keeps its own pool of database connections
+configure(
+    pool_size=int(os.environ.get("DUSQL_POOL_SIZE", 5)),
+    max_overflow=int(os.environ.get("DUSQL_MAX_OVERFLOW", 10)),
+    statement_timeout=float(os.environ.get("DUSQL_STATEMENT_TIMEOUT", 300)),
+)
+
+# Rows fetched from the database at a time when streaming results
+find_chunk_size = 1000
+
+# Largest page of find results to cache
+find_cache_limit = 1000
+
+# Largest the query log for grafanadb.warm can grow to
+query_log_limit = 64 * 1024 * 1024
+
+# Results of the current snapshot, the snapshot's generation is checked at
+# most every 10 seconds so a reload is picked up soon after it's published.
+# If DUSQL_CACHE is set the cache is shared by all processes through that
+# SQLite database.
+result_cache = open_cache(
+    os.environ.get("DUSQL_CACHE"), maxsize=8192, ttl=24 * 60 * 60
+)
+
+def reads():
+    """
+    Router for queries, to the read-only replicas in REPLICAS if there are
+    any. Replicas that haven't received the snapshot published on DATABASE
+    yet aren't used.
+    """
+    return read_router(
+        app.config["DATABASE"],
+        app.config["REPLICAS"],
+        version=current_generation,
+        interval=10,
+    )
+
+def generation():
+    """
+    Generation of the snapshot queries are currently answered from
+    """
+    return reads().version()
 
 find_schema = {
     "type": "object",
@@ -41,9 +99,49 @@ find_schema = {
         "not_gid": {"type": ["number", "null"]},
         "uid": {"type": ["number", "null"]},
         "not_uid": {"type": ["number", "null"]},
-        "mtime": {"type": ["number", "null"]},
+        "mtime": {
+            "anyOf": [
+                {"type": ["number", "null"]},
+                {"type": "string", "enum": ages + ["-" + a for a in ages]},
+            ]
+        },
         "size": {"type": ["number", "null"]},
+        "limit": {"type": ["integer", "null"], "minimum": 1},
+        "after": {"type": ["string", "null"]},
+    },
+}
+
+# Paging only applies to /find
+du_schema = {
+    "type": "object",
+    "properties": {
+        k: v for k, v in find_schema["properties"].items() if k not in ("limit", "after")
+    },
+    "additionalProperties": False,
+}
+
+top_schema = {
+    "type": "object",
+    "properties": {
+        **du_schema["properties"],
+        "count": {"type": "integer", "minimum": 1, "maximum": 1000},
+        "by": {"type": "string", "enum": ["size", "inodes"]},
+        "directories": {"type": "boolean"},
+    },
+    "additionalProperties": False,
+}
+
+children_schema = {
+    "type": "object",
+    "properties": {
+        "root_inode": {
+            "type": "array",
+            "items": [{"type": "number"}, {"type": "number"}],
+        },
+        **{k: v for k, v in du_schema["properties"].items() if k != "root_inodes"},
     },
+    "required": ["root_inode"],
+    "additionalProperties": False,
 }
 
 
@@ -60,14 +158,75 @@ def find():
     except:
         abort(400)
 
-    q = find_impl(**json)
-    with connect(url=app.config["DATABASE"]) as conn:
-        return jsonify([row.path for row in conn.execute(q)])
+    try:
+        q = find_impl(**json)
+    except ValueError:
+        # Not a cursor from encode_cursor
+        abort(400)
+
+    def rows():
+        # Stream the rows from a server-side cursor, so the results are never
+        # all in memory at once
+        with reads().connect() as conn:
+            r = conn.execution_options(stream_results=True).execute(q)
+            count = 0
+            while True:
+                chunk = r.fetchmany(find_chunk_size)
+                if len(chunk) == 0:
+                    break
+                count += len(chunk)
+                last = chunk[-1]
+                yield "".join(dumps({"path": row.path}) + "\n" for row in chunk)
+
+        # A full page ends with the cursor to get the next one from
+        if json.get("limit") is not None and count == json["limit"]:
+            after = encode_cursor(last.device, last.seq, last.root_inode, last.basename)
+            yield dumps({"after": after}) + "\n"
+
+    if json.get("limit") is not None and json["limit"] <= find_cache_limit:
+        # Pages are small enough to cache
+        page = cached("find", json, lambda json: "".join(rows()))
+        return Response(page, mimetype="application/x-ndjson")
 
-@functools.lru_cache(maxsize=8192)
-def cached_du(**json):
+    return Response(rows(), mimetype="application/x-ndjson")
+
+@app.errorhandler(sa.exc.OperationalError)
+def database_error(e):
+    """
+    Queries cancelled by the statement timeout are reported as unavailable
+    rather than a server error
+    """
+    if isinstance(e.orig, psycopg2.errors.QueryCanceled):
+        return "Query took too long", 503
+    raise e
+
+def log_query(name, json):
+    """
+    Record the query `json` to the endpoint `name` in QUERY_LOG, for
+    grafanadb.warm to find the most requested results
+
+    grafanadb.warm starts a new log each time it runs, until then nothing
+    more is recorded once the log reaches `query_log_limit` bytes
+    """
+    if app.config["QUERY_LOG"] is None:
+        return
+    with open(app.config["QUERY_LOG"], "a") as f:
+        if f.tell() < query_log_limit:
+            f.write(dumps({"endpoint": name, "query": json}) + "\n")
+
+def cached(name, json, compute):
+    """
+    The result of `compute(json)` for the endpoint `name` from the current
+    snapshot, from the cache if it's already been computed
+    """
+    log_query(name, json)
+    return result_cache.cached(
+        generation(), query_key(name, json), lambda: compute(json)
+    )
+
+def du_result(json):
     q = du_impl(**json)
-    with connect(url=app.config["DATABASE"]) as conn:
+    with reads().connect() as conn:
         r = conn.execute(q).fetchone()
         return {
             "size": float(r.size) if r.size is not None else 0.0,
@@ -82,10 +241,125 @@ def du():
         abort(401)
 
     try:
-        validate(json, schema=find_schema)
+        validate(json, schema=du_schema)
+    except:
+        abort(400)
+
+    # The total doesn't depend on the order of the roots
+    json['root_inodes'] = sorted(tuple(x) for x in json['root_inodes'])
+
+    return cached("du", json, du_result)
+
+def du_batch_result(json):
+    if len(json["root_inodes"]) == 0:
+        return []
+
+    q = du_batch_impl(**json)
+    with reads().connect() as conn:
+        totals = {(r.device, r.inode): r for r in conn.execute(q)}
+
+    result = []
+    for root in json["root_inodes"]:
+        r = totals[tuple(root)]
+        result.append({"root": root, "size": float(r.size), "inodes": r.inodes})
+    return result
+
+@app.route("/du/batch")
+def du_batch():
+    """
+    Usage of each of the roots separately, in the order they were given
+    """
+    json = request.get_json()
+
+    if json is None or json.pop("api_key", None) != app.config["API_KEY"]:
+        abort(401)
+
+    try:
+        validate(json, schema=du_schema)
+    except:
+        abort(400)
+
+    return jsonify(cached("du/batch", json, du_batch_result))
+
+def children_result(json):
+    with reads().connect() as conn:
+        directory = conn.execute(inode_impl(json["root_inode"])).fetchone()
+        if directory is None:
+            return None
+
+        q = children_impl(**json)
+        children = [
+            {
+                "root": [r.device, r.inode],
+                "basename": r.basename,
+                "type": inode_type(r.mode),
+                "size": float(r.size),
+                "inodes": r.inodes,
+            }
+            for r in conn.execute(q)
+        ]
+
+    parent = None
+    if directory.parent_inode is not None:
+        parent = [directory.device, directory.parent_inode]
+
+    return {"path": directory.path, "parent": parent, "children": children}
+
+@app.route("/children")
+def children():
+    """
+    Usage of each child of a directory, along with the directory's path and
+    parent so it can be browsed without looking at the filesystem
+    """
+    json = request.get_json()
+
+    if json is None or json.pop("api_key", None) != app.config["API_KEY"]:
+        abort(401)
+
+    try:
+        validate(json, schema=children_schema)
+    except:
+        abort(400)
+
+    result = cached("children", json, children_result)
+    if result is None:
+        abort(404)
+    return jsonify(result)
+
+def top_result(json):
+    q = top_impl(**json)
+    with reads().connect() as conn:
+        return [
+            {"path": r.path, "size": float(r.size), "inodes": r.inodes}
+            for r in conn.execute(q)
+        ]
+
+@app.route("/top")
+def top():
+    """
+    The largest files or directories under the roots
+    """
+    json = request.get_json()
+
+    if json is None or json.pop("api_key", None) != app.config["API_KEY"]:
+        abort(401)
+
+    try:
+        validate(json, schema=top_schema)
+        top_impl(**json)
     except:
         abort(400)
 
-    json['root_inodes'] = tuple(tuple(x) for x in json['root_inodes'])
+    return jsonify(cached("top", json, top_result))
+
+@app.route("/cache")
+def cache_stats():
+    """
+    Hit and miss counts of the result cache
+    """
+    json = request.get_json()
+
+    if json is None or json.pop("api_key", None) != app.config["API_KEY"]:
+        abort(401)
 
-    return cached_du(**json)
+    return jsonify(result_cache.stats())
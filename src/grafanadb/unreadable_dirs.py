@@ -99,16 +99,20 @@ def unreadable_query():
         .alias()
     )
 
-    q = sa.select(
-        [
-            subq.c.uid,
-            subq.c.gid,
-            subq.c.root_gid,
-            sa.func.dusql_path_func(
-                subq.c.parent_inode, subq.c.device, subq.c.basename
-            ).label("path"),
-        ]
-    ).alias()
+    dir_path = m.DirPath.__table__.alias("dir_path")
+
+    q = (
+        sa.select(
+            [
+                subq.c.uid,
+                subq.c.gid,
+                subq.c.root_gid,
+                m.inode_path(subq, dir_path).label("path"),
+            ]
+        )
+        .select_from(m.join_dir_path(subq, subq, dir_path))
+        .alias()
+    )
     q = sa.select(q.c).where(sa.not_(q.c.path.like("%/tmp/%")))
 
     return q
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import grafanadb.model as m
+import grafanadb.server as server
+from grafanadb.cache import open_cache, query_key
+
+import sqlalchemy as sa
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import argparse
+import json
+import os
+
+# Filters sent by 'dusql ncdu' when none are given on the command line
+no_filters = {
+    "gid": None,
+    "not_gid": None,
+    "uid": None,
+    "not_uid": None,
+    "mtime": None,
+    "size": None,
+}
+
+# Functions computing the cached result of each endpoint, /find pages aren't
+# worth warming. Scanned roots are only warmed with /children, as that is what
+# 'dusql ncdu' requests, the rest come from the query log
+results = {
+    "du": server.du_result,
+    "du/batch": server.du_batch_result,
+    "children": server.children_result,
+    "top": server.top_result,
+}
+
+
+def scanned_roots(conn):
+    """
+    (device, inode) of each root scanned by dusql_scan.py
+    """
+    q = sa.select([m.Root.device, m.Root.inode]).order_by(m.Root.device, m.Root.inode)
+    return [[r.device, r.inode] for r in conn.execute(q)]
+
+
+def warm_roots(cache, generation, roots, depth=2, jobs=4):
+    """
+    Cache the children of each of `roots`, and of every directory down to
+    `depth` levels below them, as 'dusql ncdu' would request them
+
+    Returns the number of results stored
+    """
+    seen = set()
+
+    def children(root):
+        json = {"root_inode": root, **no_filters}
+        result = server.children_result(json)
+        cache.put(generation, query_key("children", json), result)
+        return result
+
+    with ThreadPoolExecutor(jobs) as pool:
+        level = roots
+        for _ in range(depth):
+            # Nested roots would otherwise be listed more than once
+            level = [r for r in dict.fromkeys(map(tuple, level)) if r not in seen]
+            seen.update(level)
+
+            next_level = []
+            for result in pool.map(children, level):
+                if result is None:
+                    continue
+                next_level.extend(
+                    c["root"] for c in result["children"] if c["type"] == "d"
+                )
+            level = next_level
+
+    return len(seen)
+
+
+def rotate(query_log):
+    """
+    Move the server's DUSQL_QUERY_LOG aside so it starts a new one, returning
+    the old log's path
+    """
+    old = query_log + ".1"
+    os.replace(query_log, old)
+    return old
+
+
+def requested(query_log, count):
+    """
+    The `count` most requested (endpoint, query) pairs in the server's
+    DUSQL_QUERY_LOG
+    """
+    counts = collections.Counter()
+    with open(query_log) as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                # Partly written by a running server
+                continue
+            if r["endpoint"] in results:
+                counts[query_key(r["endpoint"], r["query"])] += 1
+
+    return [json.loads(key) for key, _ in counts.most_common(count)]
+
+
+def warm_requested(cache, generation, queries, jobs=4):
+    """
+    Cache the results of `queries` from :func:`requested`
+
+    Returns the number of results stored
+    """
+
+    def compute(query):
+        endpoint, json = query
+        cache.put(generation, query_key(endpoint, json), results[endpoint](json))
+
+    with ThreadPoolExecutor(jobs) as pool:
+        return len(list(pool.map(compute, queries)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill the server's result cache from a newly loaded snapshot"
+    )
+    parser.add_argument("url", help="Database the server reads")
+    parser.add_argument(
+        "--cache",
+        default=os.environ.get("DUSQL_CACHE"),
+        help="SQLite cache shared by the server's workers (default $DUSQL_CACHE)",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=2,
+        help="Levels below each scanned root to cache (default %(default)s)",
+    )
+    parser.add_argument(
+        "--query-log",
+        default=os.environ.get("DUSQL_QUERY_LOG"),
+        help="Requests logged by the server (default $DUSQL_QUERY_LOG)",
+    )
+    parser.add_argument(
+        "--requested",
+        type=int,
+        default=500,
+        metavar="N",
+        help="Number of the most requested results from the log to cache (default %(default)s)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=4,
+        help="Number of queries to run at once (default %(default)s)",
+    )
+    args = parser.parse_args()
+
+    if args.cache is None:
+        parser.error(
+            "--cache or DUSQL_CACHE is needed to share results with the server"
+        )
+
+    server.app.config["DATABASE"] = args.url
+    cache = open_cache(
+        args.cache, maxsize=server.result_cache.maxsize, ttl=server.result_cache.ttl
+    )
+
+    # Read first, so nothing from an older snapshot is stored as newer.
+    # Queries go to the server's replicas from DUSQL_REPLICAS, if any
+    generation = server.generation()
+    with server.reads().connect() as conn:
+        roots = scanned_roots(conn)
+
+    if generation is None:
+        parser.error("Nothing has been loaded into the database")
+
+    stored = warm_roots(cache, generation, roots, depth=args.depth, jobs=args.jobs)
+    print(f"Cached {stored} results from {len(roots)} roots")
+
+    if args.query_log is not None and os.path.exists(args.query_log):
+        # Only requests since the last run are counted
+        queries = requested(rotate(args.query_log), args.requested)
+        stored = warm_requested(cache, generation, queries, jobs=args.jobs)
+        print(f"Cached {stored} requested results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from grafanadb.cache import *
+
+from fixtures import *
+import sqlalchemy as sa
+import sqlite3
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def make_cache(**kwargs):
+        if request.param == "memory":
+            return ResultCache(**kwargs)
+        # Update when results were used on every hit, for testing the LRU
+        return SqliteCache(str(tmp_path / "cache.sqlite"), touch_interval=0, **kwargs)
+
+    return make_cache
+
+
+def test_query_key():
+    assert query_key("du", {"a": 1, "b": [1, 2]}) == query_key(
+        "du", {"b": [1, 2], "a": 1}
+    )
+    assert query_key("du", {"a": 1}) != query_key("top", {"a": 1})
+
+
+def test_lru(make_cache):
+    cache = make_cache(maxsize=2)
+
+    cache.put(1, "a", 1)
+    cache.put(1, "b", 2)
+    assert cache.get(1, "a") == 1
+
+    # 'b' is now the least recently used
+    cache.put(1, "c", 3)
+    assert cache.get(1, "b") is missing
+    assert cache.get(1, "a") == 1
+    assert cache.get(1, "c") == 3
+
+    stats = cache.stats()
+    assert stats["size"] == 2
+    assert stats["evictions"] == 1
+    assert stats["hits"] == 3
+    assert stats["misses"] == 1
+
+
+def test_ttl(make_cache):
+    cache = make_cache(ttl=0)
+
+    cache.put(1, "a", 1)
+    time.sleep(0.01)
+    assert cache.get(1, "a") is missing
+    assert cache.stats()["expired"] == 1
+
+
+def test_generation(make_cache):
+    cache = make_cache()
+
+    cache.put(1, "a", 1)
+    assert cache.get(2, "a") is missing
+
+    # A new generation drops the old results
+    cache.put(2, "b", 2)
+    assert cache.get(1, "a") is missing
+    assert cache.stats()["size"] == 1
+
+    # Results computed before the new generation was seen aren't kept
+    cache.put(1, "a", 1)
+    assert cache.get(2, "a") is missing
+    assert cache.get(2, "b") == 2
+
+
+def test_cached(make_cache):
+    cache = make_cache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert cache.cached(1, "a", compute) == 1
+    assert cache.cached(1, "a", compute) == 1
+    assert cache.cached(2, "a", compute) == 2
+
+
+def test_shared(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+
+    SqliteCache(path).put(1, "a", {"size": 1.0})
+
+    # Another process opening the same file sees the result
+    cache = SqliteCache(path)
+    assert cache.get(1, "a") == {"size": 1.0}
+    assert cache.stats()["hits"] == 1
+
+
+def test_read_only_hits(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = SqliteCache(path)
+    cache.put(1, "a", 1)
+
+    # Hits don't need to wait for another process writing to the cache
+    other = sqlite3.connect(path)
+    other.execute("BEGIN IMMEDIATE")
+    for i in range(10):
+        assert cache.get(1, "a") == 1
+    assert cache.get(1, "b") is missing
+    other.rollback()
+
+    stats = cache.stats()
+    assert stats["hits"] == 10
+    assert stats["misses"] == 1
+
+
+def test_current_generation(conn):
+    assert current_generation(conn) is not None
+
+    # Visible to the server's role
+    conn.execute(sa.text("SET LOCAL ROLE dusql"))
+    assert current_generation(conn) is not None
+    conn.execute(sa.text("RESET ROLE"))
+
+    conn.execute(sa.text("ALTER TABLE dusql_generation RENAME TO dusql_generation_old"))
+    assert current_generation(conn) is None
+
+
+def test_current_generation_denied(conn):
+    conn.execute(sa.text("CREATE ROLE dusql_no_access"))
+    conn.execute(sa.text("SET LOCAL ROLE dusql_no_access"))
+    with pytest.raises(sa.exc.ProgrammingError):
+        current_generation(conn)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from grafanadb import db
+
+import sqlalchemy as sa
+import pytest
+import threading
+import os
+
+url = os.environ.get("TEST_DB", db.default_url)
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(db, "engines", {})
+    monkeypatch.setattr(db, "pool_options", dict(db.pool_options))
+
+
+def test_engine_per_url(registry):
+    a = db.get_engine(url)
+    assert db.get_engine(url) is a
+
+    # A different URL to the same database gets its own pool
+    other = str(sa.engine.url.make_url(url)) + ("&" if "?" in url else "?")
+    other += "application_name=dusql"
+    b = db.get_engine(other)
+    assert b is not a
+
+    with db.connect(url) as c1, db.connect(other) as c2:
+        assert c1.execute(sa.text("SELECT 1")).scalar() == 1
+        assert c2.execute(sa.text("SELECT 1")).scalar() == 1
+        assert db.pool_status()[repr(a.url)]["checked_out"] == 1
+
+    assert db.pool_status()[repr(a.url)]["checked_out"] == 0
+
+
+def test_configure(registry):
+    with pytest.raises(TypeError):
+        db.configure(pool_sise=2)
+
+    db.configure(pool_size=2, statement_timeout=0.2)
+    engine = db.get_engine(url)
+    assert engine.pool.size() == 2
+
+    with db.connect(url) as conn:
+        assert conn.execute(sa.text("SHOW statement_timeout")).scalar() == "200ms"
+
+        with pytest.raises(sa.exc.OperationalError):
+            conn.execute(sa.text("SELECT pg_sleep(1)"))
+
+
+# A second PostgreSQL instance to use as a replica
+replica_url = os.environ.get("TEST_REPLICA")
+needs_replica = pytest.mark.skipif(replica_url is None, reason="TEST_REPLICA not set")
+
+
+def port(conn):
+    return int(conn.execute(sa.text("SELECT current_setting('port')")).scalar())
+
+
+@needs_replica
+def test_least_outstanding(registry):
+    router = db.ReadRouter(url, [replica_url, url])
+
+    with router.connect() as c1:
+        with db.connect(replica_url) as c:
+            replica_port = port(c)
+        assert port(c1) == replica_port
+
+        # The replica is busy, so the next query goes to the other one
+        with router.connect() as c2:
+            assert port(c2) != replica_port
+            assert (
+                router.status()[repr(sa.engine.url.make_url(url))]["outstanding"] == 1
+            )
+
+    with router.connect() as c3:
+        assert port(c3) == replica_port
+
+
+@needs_replica
+def test_replica_down(registry):
+    down = "postgresql://postgres@/grafana?host=/nonexistent"
+    router = db.ReadRouter(url, [down, replica_url], retry=60)
+
+    with router.connect() as c1, router.connect() as c2:
+        with db.connect(replica_url) as c:
+            assert port(c1) == port(c2) == port(c)
+
+    assert router.status()[repr(sa.engine.url.make_url(down))]["down"]
+
+
+@needs_replica
+def test_replica_behind(registry):
+    with db.connect(replica_url) as c:
+        replica_port = port(c)
+
+    # The replica hasn't received the latest version
+    router = db.ReadRouter(
+        url, [replica_url], version=lambda conn: 1 if port(conn) == replica_port else 2
+    )
+    assert router.version() == 2
+
+    with router.connect() as conn:
+        assert port(conn) != replica_port
+
+    # Caught up
+    router = db.ReadRouter(url, [replica_url], version=lambda conn: 2)
+    with router.connect() as conn:
+        assert port(conn) == replica_port
+
+
+@needs_replica
+def test_check_down(registry):
+    down = "postgresql://postgres@/grafana?host=/nonexistent"
+    checked = []
+
+    def version(conn):
+        checked.append(str(conn.engine.url))
+        return 1
+
+    router = db.ReadRouter(url, [down, replica_url], version=version, interval=0)
+    router.version()
+    assert router.status()[repr(sa.engine.url.make_url(down))]["down"]
+
+    # Replicas known to be down aren't checked again until `retry` has passed
+    checked.clear()
+    router.version()
+    assert str(sa.engine.url.make_url(down)) not in checked
+
+    # The last version is kept while the primary is unavailable
+    router.primary = down
+    assert router.version() == 1
+    with router.connect() as conn, db.connect(replica_url) as c:
+        assert port(conn) == port(c)
+
+
+def test_check_not_blocking(registry):
+    router = db.ReadRouter(url, version=lambda conn: 1, interval=0)
+    assert router.version() == 1
+
+    # Another thread is checking, the last version is used rather than waiting
+    with router.check_lock:
+        result = []
+        thread = threading.Thread(target=lambda: result.append(router.version()))
+        thread.start()
+        thread.join(timeout=10)
+        assert result == [1]
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from grafanadb.dusql_scan import *
+from grafanadb.load import tables
+import grafanadb.db as db
+
+from fixtures import *
+
+import pytest
+import os
+import csv
+import stat
+import collections
+import datetime
+import time
+import sys
+import psycopg2
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for d in ["a/b/c", "a/d", "e"]:
+        (tmp_path / d).mkdir(parents=True)
+    for i in range(20):
+        (tmp_path / "a" / f"f{i}").write_text("x" * i)
+        (tmp_path / "a/b/c" / f"g{i}").write_text("y")
+    return tmp_path
+
+
+def tree_root(path):
+    row, directory = root_directory(str(path))
+    return directory
+
+
+def without_atime(rows):
+    # Scanning a directory updates its atime
+    return sorted(r[:7] + r[8:] for r in rows)
+
+
+class ListWriter(list):
+    writerow = list.append
+    writerows = list.extend
+
+
+def expected_rollup(rows):
+    # Add every row on to itself and all of its parents the slow way
+    parents = {r[0]: r[11] for r in rows}
+    totals = collections.defaultdict(lambda: [0, 0, None])
+    for r in rows:
+        inode = r[0] if stat.S_ISDIR(r[2]) else r[11]
+        while inode is not None:
+            t = totals[(r[1], inode, r[3], r[4])]
+            t[0] += 1
+            t[1] += r[5]
+            t[2] = r[6] if t[2] is None else max(t[2], r[6])
+            inode = parents[inode]
+    return {k: tuple(v) for k, v in totals.items()}
+
+
+def sum_rollup(rollup):
+    # Total the rollup rows by (device, inode, uid, gid), over all ages
+    totals = collections.defaultdict(lambda: [0, 0, None])
+    for r in rollup:
+        t = totals[(r[0], r[1], r[3], r[4])]
+        t[0] += r[7]
+        t[1] += r[8]
+        t[2] = r[9] if t[2] is None else max(t[2], r[9])
+    return {k: tuple(v) for k, v in totals.items()}
+
+
+def check_seq(rows):
+    # Everything under a directory, and nothing else, is in its seq range
+    parents = {r[0]: r[11] for r in rows}
+    assert len({r[12] for r in rows}) == len(rows)
+
+    for d in rows:
+        if not stat.S_ISDIR(d[2]):
+            continue
+
+        expected = set()
+        for r in rows:
+            inode = r[0]
+            while inode is not None and inode != d[0]:
+                inode = parents[inode]
+            if inode is not None:
+                expected.add(r[0])
+
+        assert {r[0] for r in rows if d[12] <= r[12] <= d[12] + b"\xff"} == expected
+
+
+def test_seq_key():
+    numbers = [0, 1, 255, 256, 65535, 65536, 2 ** 40]
+    keys = [seq_key(n) for n in numbers]
+
+    assert sorted(keys) == keys
+    assert max(k[0] for k in keys) < 0xFF
+
+
+def test_scan_serial(tree):
+    rows = list(scan_serial(tree_root(tree)))
+
+    assert len(rows) == 45
+    assert {r[9] for r in rows} >= {"a", "b", "c", "d", "e", "f0", "g0"}
+
+
+def test_scan_parallel(tree):
+    root = tree_root(tree)
+
+    serial = list(scan_serial(root))
+    parallel = list(scan_parallel(root, workers=4))
+
+    assert without_atime(parallel) == without_atime(serial)
+
+
+def test_scan_pool(tree, tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("work")
+    output = workdir / "output"
+
+    scan_pool([str(tree)], str(workdir), str(output), processes=2)
+
+    rows = []
+    for shard in output.iterdir():
+        with open(shard) as f:
+            rows.extend(csv.reader(f))
+
+    assert len(rows) == 46
+    assert WorkPool(str(workdir)).finished()
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_rollup(tree, workers):
+    rows = ListWriter()
+    rollup = ListWriter()
+    scan_root(str(tree), rows, workers=workers, rollup_writer=rollup)
+
+    assert sum_rollup(rollup) == expected_rollup(rows)
+    check_seq(rows)
+    # One row per directory, since everything has the same uid and gid
+    assert len(rollup) == 6
+
+
+def test_age_bins():
+    utc = datetime.timezone.utc
+    now = datetime.datetime(2020, 3, 31, 12, tzinfo=utc).timestamp()
+    bins = age_bins(now, history_ages)
+
+    def ago(**kwargs):
+        return (
+            datetime.datetime(2020, 3, 31, 12, tzinfo=utc)
+            - datetime.timedelta(**kwargs)
+        ).timestamp()
+
+    assert age_label(now + 1, bins) is None
+    assert age_label(None, bins) is None
+    assert age_label(now, bins) is None
+    assert age_label(now - 1, bins) == "P0D"
+    # A month before the 31st of March is the 29th of February, and like
+    # PostgreSQL's ranges the bins include their start but not their end
+    assert age_label(ago(days=32), bins) == "P1M"
+    assert age_label(ago(days=31), bins) == "P0D"
+    assert age_label(ago(days=400), bins) == "P1Y"
+    assert age_label(ago(days=4000), bins) == "P3Y"
+
+
+def test_rollup_ages(tree):
+    day = 24 * 60 * 60
+    ages = [0, 40, 200, 400, 2000]
+    for i in range(20):
+        modified = time.time() - ages[i % 5] * day
+        os.utime(tree / "a" / f"f{i}", (time.time(), modified))
+
+    rows = ListWriter()
+    rollup = ListWriter()
+    scan_root(str(tree), rows, rollup_writer=rollup)
+
+    root = os.stat(tree).st_ino
+    totals = collections.Counter()
+    for r in rollup:
+        if r[1] == root:
+            assert r[2] == root
+            totals[r[5]] += r[7]
+
+    assert totals == {"P0D": 30, "P1M": 4, "P6M": 4, "P1Y": 4, "P3Y": 4}
+
+
+def test_scan_pool_rollup(tree, tmp_path_factory):
+    workdir = tmp_path_factory.mktemp("work")
+    output = workdir / "output"
+
+    # Subdirectories get given away to the other processes
+    scan_pool(
+        [str(tree)], str(workdir), str(output), processes=3, output=Output(rollup=True)
+    )
+
+    rows = []
+    rollup = []
+    for shard in output.iterdir():
+        if shard.name.startswith("dusql_rollup."):
+            rollup.extend(read_scan(str(shard), rollup=True))
+        else:
+            rows.extend(read_scan(str(shard)))
+
+    assert len(rows) == 46
+    assert sum_rollup(rollup) == expected_rollup(rows)
+    check_seq(rows)
+
+
+def test_scan_previous(tree, tmp_path_factory):
+    # Directories modified recently are always re-scanned
+    for path, dirs, files in os.walk(tree):
+        os.utime(path, (0, 0))
+
+    old = tmp_path_factory.mktemp("old")
+    with Output().open(str(old / "scan.csv")) as writer:
+        writer.writerows(scan_serial(tree_root(tree)))
+    previous = PreviousScan.build(str(old / "scan.sqlite"), [str(old / "scan.csv")])
+
+    (tree / "e" / "new").write_text("z")
+    rows = {r[9]: r for r in scan_serial(tree_root(tree), previous=previous)}
+
+    assert len(rows) == 46
+    assert "new" in rows
+    # Unchanged directories reuse the previous scan's rows
+    assert rows["f1"][8] < rows["new"][8]
+    assert rows["g1"][8] < rows["new"][8]
+
+
+def test_scan_previous_moved(tmp_path):
+    # A directory moved to another scanned root keeps its old mtime
+    for d in ["p1/a/b", "p2/z"]:
+        (tmp_path / d).mkdir(parents=True)
+    (tmp_path / "p1/a/b/f").write_text("x")
+
+    def scan(previous=None):
+        return [
+            r
+            for root in ["p1", "p2"]
+            for r in scan_serial(tree_root(tmp_path / root), previous=previous)
+        ]
+
+    for path, dirs, files in os.walk(tmp_path):
+        os.utime(path, (0, 0))
+    with Output().open(str(tmp_path / "scan.csv")) as writer:
+        writer.writerows(scan())
+    previous = PreviousScan.build(
+        str(tmp_path / "scan.sqlite"), [str(tmp_path / "scan.csv")]
+    )
+
+    (tmp_path / "p1/a/b").rename(tmp_path / "p2/z/b")
+    os.utime(tmp_path / "p2/z/b", (0, 0))
+
+    rows = {r[9]: r for r in scan(previous)}
+    p2 = os.stat(tmp_path / "p2")
+
+    assert rows["f"][8] < rows["b"][8]
+    assert rows["f"][10] == rows["b"][10] == p2.st_ino
+    assert rows["f"][11] == rows["b"][0]
+    assert rows["f"][12] > rows["b"][12]
+
+
+def test_write_delta(tree, tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("delta")
+    output = Output("binary")
+
+    def scan(name, previous=None):
+        path = str(tmp / output.name(name))
+        with output.open(path) as writer:
+            writer.writerows(scan_serial(tree_root(tree), previous=previous))
+        return path, PreviousScan.build(str(tmp / f"{name}.sqlite"), [path])
+
+    old_path, old = scan("old")
+
+    (tree / "e" / "new").write_text("z")
+    (tree / "a" / "f1").unlink()
+    (tree / "a" / "f2").write_text("longer")
+    (tree / "a" / "b").rename(tree / "e" / "b")
+
+    new_path, new = scan("new", old)
+
+    inserts, deletes = ListWriter(), ListWriter()
+    write_delta(old, new, inserts, deletes)
+
+    assert {r[9] for r in inserts} >= {"new", "f2", "b"}
+    assert {r[9] for r in deletes} >= {"f1", "f2", "b"}
+
+    # Applying the delta to the old scan gives the new scan
+    def key(r):
+        # Changes to atime and scan_time alone aren't included
+        return r[:7] + r[9:]
+
+    applied = sorted(
+        [key(r) for r in read_scan(old_path) if key(r) not in map(key, deletes)]
+        + [key(r) for r in inserts]
+    )
+    assert applied == sorted(key(r) for r in read_scan(new_path))
+
+
+@pytest.mark.parametrize("output_format", writers.keys())
+@pytest.mark.parametrize("compress", [False, True])
+def test_output_format(tree, tmp_path_factory, output_format, compress):
+    output = Output(output_format, compress)
+    path = str(tmp_path_factory.mktemp("out") / output.name("scan"))
+
+    rows = list(scan_serial(tree_root(tree)))
+    # Include an unreadable entry
+    rows.append(rows[0][:1] + (None,) * 8 + rows[0][9:])
+
+    with output.open(path) as writer:
+        writer.writerows(rows)
+
+    assert list(read_scan(path)) == rows
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_scan_pool_resume(tree, tmp_path_factory, compress):
+    workdir = str(tmp_path_factory.mktemp("work"))
+    output_dir = tmp_path_factory.mktemp("output")
+    output = Output("binary", compress)
+
+    # Start a scan, then get killed while scanning the root
+    pool = WorkPool(workdir)
+    path = str(output_dir / output.name("killed"))
+    with output.open(path) as writer:
+        pool.seed([str(tree)], writer)
+        pool.checkpoint(output, [(writer, path)])
+
+        name, root, skip = pool.claim()
+        for row, subdir in scan_directory(root):
+            if subdir is not None and os.path.basename(subdir.path) == b"a":
+                # Already given away to another process
+                pool.put(subdir, donor=name)
+            writer.writerow(row)
+        writer.flush()
+
+        # Crash without writing a trailer
+        writer.finish = lambda: None
+
+    scan_pool([], workdir, str(output_dir), processes=2, output=output, resume=True)
+
+    rows = [r for shard in output_dir.iterdir() for r in read_scan(str(shard))]
+    assert len(rows) == 46
+    assert len({r[0] for r in rows}) == 46
+    assert WorkPool(workdir).finished()
+
+
+@pytest.fixture
+def copy_table():
+    """
+    Table for the scan to COPY into, which has to exist outside of the test's
+    transaction as the scan commits from its own connection. Request it
+    before `conn`, so it's dropped once the test's transaction has finished
+    """
+    url = os.environ.get("TEST_DB", db.default_url)
+    table = f"dusql_copy_test_{os.getpid()}"
+
+    setup = psycopg2.connect(url)
+    setup.autocommit = True
+    with setup.cursor() as cur:
+        cur.execute(f"CREATE UNLOGGED TABLE {table} ({tables['dusql_inode'][0]})")
+    yield url, table
+
+    with setup.cursor() as cur:
+        cur.execute(f"DROP TABLE {table}")
+    setup.close()
+
+
+def test_copy_to(tree, tmp_path_factory, monkeypatch, copy_table, conn):
+    url, table = copy_table
+    path = str(tmp_path_factory.mktemp("out") / "dusql.csv")
+
+    for args in [["--copy-to", url, "--copy-table", table], ["--output", path]]:
+        monkeypatch.setattr(sys, "argv", ["dusql_scan.py", *args, str(tree)])
+        main()
+
+    copied = conn.execute(f"SELECT {', '.join(columns)} FROM {table}")
+    copied = [tuple(r[:-1]) + (bytes(r[-1]),) for r in copied]
+
+    # Each scan has its own atime and scan_time
+    def key(r):
+        return r[:7] + r[9:]
+
+    assert len(copied) == 46
+    assert sorted(map(key, copied)) == sorted(map(key, read_scan(path)))
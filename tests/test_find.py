@@ -19,6 +19,8 @@
 from grafanadb.find import *
 
 from fixtures import *
+import grafanadb.model as m
+import stat
 
 
 def test_find_single(conn):
@@ -44,3 +46,168 @@ def test_du(conn):
     r = conn.execute(q).fetchone()
     assert r.inodes > 0
     assert r.size > 0
+
+
+def test_du_rollup(conn):
+    args = find_parse(["/short/w35/saw562/scratch", "/short/w35/saw562/tmp"])
+    args.pop("api_key")
+    rollup = conn.execute(du_impl(**args)).fetchone()
+
+    # Filtering on size >= 0 has to walk the tree
+    args["size"] = 0
+    walked = conn.execute(du_impl(**args)).fetchone()
+
+    assert rollup.size == walked.size
+
+
+def test_du_rollup_filtered(conn):
+    args = find_parse(
+        ["/short/w35/saw562/scratch", "/short/w35/saw562/tmp"], user="saw562"
+    )
+    args.pop("api_key")
+
+    # Ages line up with how the totals are split, so don't walk the tree
+    for mtime in ["P1Y", "-P1Y"]:
+        args["mtime"] = mtime
+        rollup = conn.execute(du_impl(**args)).fetchone()
+
+        walked = recursive_search(**args).alias("find")
+        walked = conn.execute(
+            sa.select([sa.func.sum(walked.c.size), sa.func.count()])
+        ).fetchone()
+
+        assert rollup.size == walked[0]
+        assert rollup.inodes == walked[1]
+
+
+def test_du_batch(conn):
+    paths = ["/short/w35/saw562/scratch", "/short/w35/saw562/tmp"]
+    args = find_parse(paths)
+    args.pop("api_key")
+
+    batch = {(r.device, r.inode): r for r in conn.execute(du_batch_impl(**args))}
+    assert len(batch) == len(paths)
+
+    for root in args["root_inodes"]:
+        single = conn.execute(du_impl(**dict(args, root_inodes=[root]))).fetchone()
+        assert batch[root].size == single.size
+        assert batch[root].inodes == single.inodes
+
+
+def test_children(conn):
+    path = "/short/w35/saw562"
+    args = find_parse(path)
+    args.pop("api_key")
+    root = args.pop("root_inodes")[0]
+
+    children = {r.basename: r for r in conn.execute(children_impl(root, **args))}
+    assert set(children) == set(os.listdir(path))
+
+    for name in ["scratch", "tmp"]:
+        assert inode_type(children[name].mode) == "d"
+        du = conn.execute(
+            du_impl(
+                **args, root_inodes=[find_parse(f"{path}/{name}")["root_inodes"][0]]
+            )
+        ).fetchone()
+        assert children[name].size == du.size
+
+
+def test_find_pages(conn):
+    args = find_parse("/short/w35/saw562/scratch")
+    args.pop("api_key")
+    full = {r.path for r in conn.execute(find_impl(**args))}
+
+    paged = []
+    after = None
+    while True:
+        page = conn.execute(find_impl(**args, limit=100, after=after)).fetchall()
+        paged.extend(r.path for r in page)
+        if len(page) < 100:
+            break
+        last = page[-1]
+        after = encode_cursor(last.device, last.seq, last.root_inode, last.basename)
+
+    assert len(paged) == len(full)
+    assert set(paged) == full
+
+
+def test_find_pages_roots(conn):
+    # Two separately scanned roots start from the same seq, and hard links
+    # in the same directory share a seq
+    from grafanadb.dusql_scan import seq_key
+
+    device = -42
+    root = seq_key(0)
+    rows = [
+        ("/r1", 1001, stat.S_IFDIR, 1001, None, root),
+        ("a", 1002, stat.S_IFREG, 1001, 1001, root + seq_key(1002)),
+        ("b", 1002, stat.S_IFREG, 1001, 1001, root + seq_key(1002)),
+        ("/r2", 2001, stat.S_IFDIR, 2001, None, root),
+        ("c", 2002, stat.S_IFREG, 2001, 2001, root + seq_key(2002)),
+    ]
+    for basename, inode, mode, root_inode, parent_inode, seq in rows:
+        conn.execute(
+            m.Inode.__table__.insert().values(
+                basename=basename,
+                inode=inode,
+                device=device,
+                mode=mode,
+                uid=0,
+                gid=0,
+                size=1,
+                mtime=0,
+                scan_time=0,
+                root_inode=root_inode,
+                parent_inode=parent_inode,
+                seq=seq,
+            )
+        )
+    conn.execute(
+        m.DirPath.__table__.insert(),
+        [
+            {"device": device, "inode": 1001, "path": "/r1"},
+            {"device": device, "inode": 2001, "path": "/r2"},
+        ],
+    )
+
+    args = {
+        "root_inodes": [(device, 1001), (device, 2001)],
+        "gid": None,
+        "not_gid": None,
+        "uid": None,
+        "not_uid": None,
+        "mtime": None,
+        "size": None,
+    }
+
+    paged = []
+    after = None
+    while True:
+        page = conn.execute(find_impl(**args, limit=1, after=after)).fetchall()
+        paged.extend(r.path for r in page)
+        if len(page) < 1:
+            break
+        last = page[-1]
+        after = encode_cursor(last.device, last.seq, last.root_inode, last.basename)
+
+    assert sorted(paged) == ["/r1", "/r1/a", "/r1/b", "/r2", "/r2/c"]
+
+
+def test_top(conn):
+    args = find_parse("/short/w35/saw562/scratch")
+    args.pop("api_key")
+
+    top = conn.execute(top_impl(**args, count=10)).fetchall()
+    assert len(top) <= 10
+    assert [r.size for r in top] == sorted([r.size for r in top], reverse=True)
+
+    # The largest file is the first one found by sorting everything
+    q = recursive_search(**args).alias("find")
+    largest = conn.execute(
+        sa.select([sa.func.max(q.c.size)]).where(~is_dir(q.c.mode))
+    ).scalar()
+    assert top[0].size == largest
+
+    dirs = conn.execute(top_impl(**args, count=10, directories=True)).fetchall()
+    assert dirs[0].path == "/short/w35/saw562/scratch"
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from grafanadb.load import *
+from grafanadb.dusql_scan import (
+    Output,
+    PreviousScan,
+    root_directory,
+    scan_serial,
+    scan_entry,
+    unreadable_stat,
+    write_delta,
+)
+
+from fixtures import *
+import pytest
+import os
+
+
+@pytest.fixture
+def cur(conn):
+    """
+    Cursor where the snapshot's tables are empty temporary tables, which are
+    searched before the public views
+    """
+    cur = conn.connection.cursor()
+    for name in ["dusql_inode", "dusql_dir_path", "dusql_root"]:
+        definition, indexes = tables[name]
+        cur.execute(f"CREATE TEMPORARY TABLE {name} ({definition}) ON COMMIT DROP")
+        for index, unique, on in indexes:
+            cur.execute(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX ON pg_temp.{name}({on})"
+            )
+    for name in ["dusql_insert", "dusql_delete"]:
+        cur.execute(
+            f"CREATE TEMPORARY TABLE {name} (LIKE pg_temp.dusql_inode) ON COMMIT DROP"
+        )
+    yield cur
+    cur.close()
+
+
+def insert(cur, table, rows):
+    cur.executemany(
+        f"INSERT INTO {table}({', '.join(columns)}) "
+        f"VALUES ({', '.join(['%s'] * len(columns))})",
+        [tuple(r) for r in rows],
+    )
+
+
+def scan(path, index=0):
+    row, directory = root_directory(str(path), index)
+    return [row] + list(scan_serial(directory))
+
+
+class ListWriter(list):
+    writerow = list.append
+    writerows = list.extend
+
+
+def test_merge_unreadable(cur, tmp_path):
+    tree = tmp_path / "tree"
+    (tree / "a").mkdir(parents=True)
+    (tree / "a" / "f").write_text("x")
+
+    old = scan(tree)
+    a = next(r for r in old if r[9] == "a")
+    # Couldn't be read, or was removed between listing and stat()
+    old.append(
+        scan_entry(a[1], a[0], a[8], b"gone", unreadable_stat, a[10], a[12] + b"\x01")
+    )
+    new = scan(tree)
+
+    shards = {}
+    for name, rows in [("old", old), ("new", new)]:
+        path = str(tmp_path / f"{name}.csv")
+        with Output().open(path) as writer:
+            writer.writerows(rows)
+        shards[name] = PreviousScan.build(str(tmp_path / f"{name}.sqlite"), [path])
+
+    inserts, deletes = ListWriter(), ListWriter()
+    write_delta(shards["old"], shards["new"], inserts, deletes)
+    assert "gone" in [r[9] for r in deletes]
+
+    insert(cur, "dusql_inode", old)
+    insert(cur, "dusql_insert", inserts)
+    insert(cur, "dusql_delete", deletes)
+    cur.execute(merge_sql)
+
+    cur.execute(f"SELECT {', '.join(columns)} FROM dusql_inode")
+    merged = cur.fetchall()
+
+    # Changes to atime and scan_time alone aren't in the delta
+    def key(r):
+        return r[:7] + (r[9],) + tuple(r[10:12]) + (bytes(r[12]),)
+
+    assert sorted(map(key, merged)) == sorted(map(key, new))
+
+
+def test_path_nested_roots(cur, tmp_path):
+    outer = tmp_path / "outer"
+    inner = outer / "inner"
+    deep = inner.joinpath(*["d"] * 30)
+    deep.mkdir(parents=True)
+
+    # Each level below the inner root is in dusql_inode twice, once for each
+    # root, which shouldn't double the rows walked at every level
+    cur.execute("SET LOCAL statement_timeout = '10s'")
+
+    insert(cur, "dusql_inode", scan(outer, 0) + scan(inner, 1))
+    cur.execute(path_sql)
+
+    cur.execute("SELECT path FROM dusql_dir_path")
+    paths = [r[0] for r in cur.fetchall()]
+    assert sorted(paths) == sorted(
+        [str(outer)] + [os.path.join(d, n) for d, ns, _ in os.walk(outer) for n in ns]
+    )
+
+    # A new directory at the bottom is added under both roots
+    (deep / "new").mkdir()
+    new = [r for r in scan(outer, 0) + scan(inner, 1) if r[9] == "new"]
+    assert len(new) == 2
+    insert(cur, "dusql_insert", new)
+    cur.execute(merge_sql)
+    cur.execute(merge_path_sql)
+
+    cur.execute("SELECT path FROM dusql_dir_path WHERE inode = %s", (new[0][0],))
+    assert [r[0] for r in cur.fetchall()] == [str(deep / "new")]
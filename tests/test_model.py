@@ -40,3 +40,12 @@ def test_inode(session):
     assert inode.parent is not None
 
     assert inode.path is not None
+
+
+def test_inode_path(session):
+    inode = session.query(model.Inode).filter(model.Inode.parent_inode != None).first()
+
+    compat = session.query(
+        sa.func.dusql_path_func(inode.parent_inode, inode.device, inode.basename)
+    ).scalar()
+    assert inode.path == compat
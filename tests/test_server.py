@@ -19,6 +19,7 @@
 from grafanadb.server import *
 
 import pytest
+import json
 
 
 @pytest.fixture
@@ -51,11 +52,12 @@ def test_find(client):
 
     r = client.get("/find", json=query)
     assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
 
-    j = r.get_json()
+    j = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
 
     assert len(j) > 0
-    assert isinstance(j[0], str)
+    assert isinstance(j[0]["path"], str)
 
 
 def test_du(client):
@@ -77,3 +79,69 @@ def test_du(client):
 
     assert j["size"] > 0
     assert j["inodes"] > 0
+
+
+def test_du_batch(client):
+    query = {
+        "root_inodes": [(2901541690, 145501262337629518)],
+        "gid": None,
+        "not_gid": None,
+        "uid": None,
+        "not_uid": None,
+        "mtime": None,
+        "size": None,
+        "api_key": "test_key",
+    }
+
+    r = client.get("/du/batch", json=query)
+    assert r.status_code == 200
+
+    j = r.get_json()
+
+    assert len(j) == 1
+    assert j[0]["root"] == [2901541690, 145501262337629518]
+    assert j[0]["size"] > 0
+
+
+def test_children(client):
+    query = {
+        "root_inode": (2901541690, 145501262337629518),
+        "gid": None,
+        "not_gid": None,
+        "uid": None,
+        "not_uid": None,
+        "mtime": None,
+        "size": None,
+        "api_key": "test_key",
+    }
+
+    r = client.get("/children", json=query)
+    assert r.status_code == 200
+
+    j = r.get_json()
+
+    assert isinstance(j["path"], str)
+    assert len(j["children"]) > 0
+    assert isinstance(j["children"][0]["basename"], str)
+
+
+def test_top(client):
+    query = {
+        "root_inodes": [(2901541690, 145501262337629518)],
+        "gid": None,
+        "not_gid": None,
+        "uid": None,
+        "not_uid": None,
+        "mtime": None,
+        "size": None,
+        "count": 5,
+        "api_key": "test_key",
+    }
+
+    r = client.get("/top", json=query)
+    assert r.status_code == 200
+
+    j = r.get_json()
+
+    assert 0 < len(j) <= 5
+    assert isinstance(j[0]["path"], str)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2019 Scott Wales
+#
+# Author: Scott Wales <scott.wales@unimelb.edu.au>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from grafanadb.warm import *
+from grafanadb.cache import ResultCache, query_key, missing
+import grafanadb.db as db
+
+from fixtures import *
+import pytest
+import json
+import os
+
+
+@pytest.fixture
+def warm_server():
+    server.app.config["DATABASE"] = os.environ.get("TEST_DB", db.default_url)
+    server.app.config["REPLICAS"] = []
+
+
+def test_requested(tmp_path):
+    log = tmp_path / "queries.log"
+    du = {"root_inodes": [[1, 2]], **no_filters}
+    children = {"root_inode": [1, 3], **no_filters}
+
+    with open(log, "w") as f:
+        for endpoint, query in [
+            ("du", du),
+            ("children", children),
+            ("children", children),
+            ("find", du),
+        ]:
+            f.write(json.dumps({"endpoint": endpoint, "query": query}) + "\n")
+        # Still being written by the server
+        f.write('{"endpoint": "du", ')
+
+    assert requested(str(log), 10) == [["children", children], ["du", du]]
+    assert requested(str(log), 1) == [["children", children]]
+
+
+def test_rotate(tmp_path):
+    log = str(tmp_path / "queries.log")
+    with open(log, "w") as f:
+        f.write("{}\n")
+
+    old = rotate(log)
+    assert not os.path.exists(log)
+    with open(old) as f:
+        assert f.read() == "{}\n"
+
+
+def test_warm_roots(conn, warm_server):
+    roots = scanned_roots(conn)
+    assert len(roots) > 0
+
+    cache = ResultCache()
+    generation = server.generation()
+    stored = warm_roots(cache, generation, roots[:1], depth=2)
+
+    # The root's listing is what the server would have computed
+    query = {"root_inode": roots[0], **no_filters}
+    result = cache.get(generation, query_key("children", query))
+    assert result == server.children_result(query)
+
+    # Along with the next level down
+    for child in result["children"]:
+        if child["type"] == "d":
+            query = {"root_inode": child["root"], **no_filters}
+            assert cache.get(generation, query_key("children", query)) is not missing
+
+    # Totals aren't cached on their own, 'dusql ncdu' never asks for them
+    query = {"root_inodes": roots[:1], **no_filters}
+    assert cache.get(generation, query_key("du", query)) is missing
+
+    assert cache.stats()["size"] == stored
+
+    # Listing a root again doesn't count twice
+    assert warm_roots(ResultCache(), generation, roots[:1] * 2, depth=1) == 1
+
+
+def test_warm_requested(conn, warm_server):
+    roots = scanned_roots(conn)
+    queries = [
+        ["du", {"root_inodes": roots[:1], **no_filters, "mtime": "P1Y"}],
+        ["top", {"root_inodes": roots[:1], **no_filters, "count": 5}],
+    ]
+
+    cache = ResultCache()
+    generation = server.generation()
+    assert warm_requested(cache, generation, queries) == 2
+
+    for endpoint, query in queries:
+        expected = results[endpoint](query)
+        assert cache.get(generation, query_key(endpoint, query)) == expected